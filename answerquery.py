@@ -1,75 +1,105 @@
+import sys, heapq
 import graphmanager as graph
 import resourceutil
 from peewee import *
+from operator import itemgetter
+from lrucache import LRUCache
+from scoring import ALPHA, InvertedIndex, UserIndex
 
-# weighting factor between stems and entities in resource score calculation
-ALPHA = 0.6
+# number of rows per INSERT when persisting scores
+INSERT_BATCH_SIZE = 1000
 
-# example of a query
-query = 'What are some good place to hang out for a young professional in East London?'
+# maximum number of answers kept by a QueryCache
+QUERY_CACHE_SIZE = 10000
+# located resources of each of the best users in an answer
+LOCATED_RESOURCES_PER_USER = 2
 
-# init
-db = MySQLDatabase('expertfinding', host='127.0.0.1', user='root', passwd='')
-db.connect()
-# start fresh
-graph.UserScore.create_table(True)
-graph.ResourceScore.create_table(True)
+class QueryCache(object):
+    '''Answers of recent queries keyed by their sorted stems and entity titles, so
+       that queries worded differently but reduced to the same terms share an answer,
+       and by the version of the graph the indexes were built from.
+       Emptied whenever this process ingests resources, until closed.'''
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.answers = LRUCache(size)
+        graph.on_ingest(self.answers.clear)
+
+    def key(self, query_stems, query_entities, version, limit):
+        # the score of a term counts as many times as the term appears in the query
+        return (version, limit, tuple(sorted(query_stems)), 
+            tuple(sorted(entity['entity'] for entity in query_entities)))
+
+    def get(self, key):
+        return self.answers.get(key)
+
+    def put(self, key, answer):
+        self.answers.put(key, answer)
+
+    def clear(self):
+        self.answers.clear()
+
+    def statistics(self):
+        return self.answers.statistics()
+
+    def close(self):
+        '''Stop listening to the ingestion of this process.'''
+        graph.remove_ingest_listener(self.answers.clear)
+
+def get_inverse_frequencies(query_stems, query_entities):
+    '''Read the inverse resource frequency of the query terms from the 
+       precomputed doc_freq columns. Returns two dicts {term: irf}.'''
+    stem_irfs = {}
+    if query_stems:
+        for stem in graph.Stem.select().where(graph.Stem.stem << list(set(query_stems))):
+            if stem.doc_freq > 0:
+                stem_irfs[stem.stem] = 1. / stem.doc_freq
+    entity_irfs = {}
+    entity_titles = list(set(entity['entity'] for entity in query_entities))
+    if entity_titles:
+        for entity in graph.Entity.select().where(graph.Entity.entity << entity_titles):
+            if entity.doc_freq > 0:
+                entity_irfs[entity.entity] = 1. / entity.doc_freq
+    return stem_irfs, entity_irfs
+
+def compute_resource_score(resource, query_stems, query_entities, irfs=None):
+    '''irfs: output of get_inverse_frequencies, computed once per query if not provided.'''
+    if irfs is None:
+        irfs = get_inverse_frequencies(query_stems, query_entities)
+    stem_irfs, entity_irfs = irfs
 
-def compute_resource_score(resource, query_stems, query_entities):
     stem_score = 0
     for stem in query_stems:
         # term frequency in the resource
         tf = (graph.ResourceStem
-            .select()
+            .select(graph.ResourceStem.tf)
             .join(graph.Stem)
             .where(
                 (graph.ResourceStem.resource == resource) 
                 & (graph.Stem.stem == stem))
-            .count())
+            .scalar()) or 0
         # inverse resource frequency in all resources
-        rf = (graph.ResourceStem
-            .select()
-            .join(graph.Stem)
-            .where(graph.Stem.stem == stem)
-            .count())
-        if rf > 0:
-            irf = 1. / rf
-        else:
-            irf = 1.
+        irf = stem_irfs.get(stem, 1.)
         # compute score
         stem_score = stem_score + tf * (irf * irf)
 
     entity_score = 0
     for entity in query_entities:
-        # entity frequency in the resource
-        ef = (graph.ResourceEntity
-            .select()
+        # entity frequency in the resource and sum of its rho
+        ef, rho_sum = (graph.ResourceEntity
+            .select(graph.ResourceEntity.count, graph.ResourceEntity.rho_sum)
             .join(graph.Entity)
             .where(
                 (graph.ResourceEntity.resource == resource) 
                 & (graph.Entity.entity == entity['entity']))
-            .count())
+            .tuples()
+            .first()) or (0, 0.0)
         # inverse resource frequency in all resources
-        rf = (graph.ResourceEntity
-            .select()
-            .join(graph.Entity)
-            .where(graph.Entity.entity == entity['entity'])
-            .count())
-        if rf > 0:
-            eirf = 1. / rf
-        else:
-            eirf = 1.
+        eirf = entity_irfs.get(entity['entity'], 1.)
         # compute score
         weight = 0.0
-        count = 0.0
-        for e in graph.ResourceEntity.select().join(graph.Entity).where(
-            (graph.ResourceEntity.resource == resource) 
-            & (graph.Entity.entity == entity['entity'])):
-            count = count + 1
-            weight = weight + e.rho
         # average of all rho for a given resource
-        if count > 0:
-            weight = weight / count
+        if ef > 0:
+            weight = rho_sum / ef
         if weight > 0:
             weight = weight + 1
         entity_score = entity_score + weight * ef * (eirf * eirf)
@@ -137,15 +167,127 @@ def get_best_results():
                     unique.add(resource.external_id)
     return best_resources
 
-# query_stems = resourceutil.extract_stems(query)
-# query_entities = resourceutil.extract_entities(query)
+def answer(query, index=None, user_index=None, limit=10, persist=False, cache=None, version=None,
+    matrix=False):
+    '''Answer a query without writing to the shared UserScore and ResourceScore 
+       tables, so several queries can be answered at once.
+       Indexes are built from the graph if not provided: InvertedIndex and UserIndex,
+       or a single matrixscoring.MatrixIndex if matrix.
+       Answers are looked up in and added to cache (a QueryCache) if given, version is
+       the version of the indexes: the one they were built with by default.
+       Returns the best users as [(user, score), ...] and their best located resources.'''
+    query_stems = resourceutil.extract_stems(query)
+    query_entities = resourceutil.extract_entities(query)
+    key = None
+    if cache is not None and not persist:
+        if version is None:
+            version = (getattr(index, 'version', None), getattr(user_index, 'version', None))
+            if None in version:
+                # indexes built below or not from the graph
+                version = graph.graph_version()
+        key = cache.key(query_stems, query_entities, version, limit)
+        cached_answer = cache.get(key)
+        if cached_answer is not None:
+            return cached_answer
+
+    if matrix and index is None and user_index is None:
+        import matrixscoring
+        index = user_index = matrixscoring.MatrixIndex().build()
+    if index is None:
+        index = InvertedIndex().build()
+    if user_index is None:
+        user_index = UserIndex().build()
+
+    resource_scores = index.score_resources(query_stems, query_entities)
+    if persist:
+        user_scores = user_index.score_users(resource_scores)
+        persist_scores(query, resource_scores, user_scores)
+        best_users = heapq.nlargest(limit, user_scores.iteritems(), key=itemgetter(1))
+    else:
+        # only score the users that can make it to the top
+        best_users = user_index.top_users(resource_scores, limit)
+    result = get_experts(best_users), get_located_resources(best_users, resource_scores, user_index, limit)
+    if key is not None:
+        cache.put(key, result)
+    return result
+
+def get_experts(best_users):
+    '''Load the users of a [(user uid, score), ...] ranking.'''
+    if not best_users:
+        return []
+    users = dict((user.uid, user) for user in 
+        graph.User.select().where(graph.User.uid << [uid for uid, score in best_users]))
+    return [(users[uid], score) for uid, score in best_users]
+
+def get_located_resources(best_users, resource_scores, user_index, limit=10):
+    '''In-memory equivalent of get_best_results: the LOCATED_RESOURCES_PER_USER best
+       located resources of each of the best users.'''
+    unique = set()
+    best_resources = []
+    for user_uid, score in best_users:
+        if len(best_resources) >= limit:
+            break
+        resource_uids = user_index.best_resources(user_uid, resource_scores)
+        if not resource_uids:
+            continue
+        located = dict((resource.uid, resource) for resource in graph.Resource.select().where(
+            (graph.Resource.uid << resource_uids) & ~(graph.Resource.location_name >> None)))
+        for resource in [located[uid] for uid in resource_uids if uid in located][:LOCATED_RESOURCES_PER_USER]:
+            if resource.external_id not in unique and resource.location_name.strip() != '':
+                best_resources.append(resource)
+                unique.add(resource.external_id)
+    return best_resources
+
+def persist_scores(query, resource_scores, user_scores):
+    '''Bulk insert the scores of a query into tables scoped by the query id.
+       Returns the ExpertQuery created.'''
+    with graph.db.transaction():
+        expert_query = graph.ExpertQuery.create(text=query)
+        rows = [{'query': expert_query.uid, 'resource': uid, 'score': score}
+            for uid, score in resource_scores.iteritems()]
+        for i in xrange(0, len(rows), INSERT_BATCH_SIZE):
+            graph.QueryResourceScore.insert_many(rows[i:i + INSERT_BATCH_SIZE]).execute()
+        rows = [{'query': expert_query.uid, 'owner': uid, 'score': score}
+            for uid, score in user_scores.iteritems()]
+        for i in xrange(0, len(rows), INSERT_BATCH_SIZE):
+            graph.QueryUserScore.insert_many(rows[i:i + INSERT_BATCH_SIZE]).execute()
+    return expert_query
+
+if __name__ == '__main__':
+    # usage: python answerquery.py [query], see queryserver.py to answer several queries
+    query = 'What are some good place to hang out for a young professional in East London?'
+    if len(sys.argv) > 1:
+        query = sys.argv[1]
+
+    # init
+    graph.init_graph()
+
+    # query_stems = resourceutil.extract_stems(query)
+    # query_entities = resourceutil.extract_entities(query)
+    # irfs = get_inverse_frequencies(query_stems, query_entities)
+
+    # for resource in graph.Resource.select():
+    #     print str(resource.uid)
+    #     compute_resource_score(resource, query_stems, query_entities, irfs)
+
+    # faster alternative: only score resources containing at least one query term
+    # index = InvertedIndex().build()
+    # graph.ResourceScore.insert_many([
+    #     {'resource': resource_uid, 'score': score} 
+    #     for resource_uid, score in index.score_resources(query_stems, query_entities).iteritems()
+    # ]).execute()
+
+    # vectorized alternative: score all resources and users at once
+    # experts, resources = answer(query, matrix=True)
 
-# for resource in graph.Resource.select():
-#     print str(resource.uid)
-#     compute_resource_score(resource, query_stems, query_entities)
+    # for user in graph.User.select().where(graph.User.completed == True):
+    #     compute_user_score(user)
 
-# for user in graph.User.select().where(graph.User.completed == True):
-#     compute_user_score(user)
+    # for best_result in get_best_results():
+    #     print best_result.url
 
-for best_result in get_best_results():
-    print best_result.url
+    experts, resources = answer(query)
+    for user, score in experts:
+        print user.url + ' ' + str(score)
+    for resource in resources:
+        print resource.url
@@ -0,0 +1,389 @@
+'''Benchmarks of the hot paths of the crawler and of the query answering.
+   Graph benchmarks run against an in-memory SQLite database.
+   usage: python benchmark.py <benchmark>'''
+import re, sys, time, random, subprocess
+import graphmanager as graph
+import nltk
+import resourceutil
+from peewee import SqliteDatabase
+
+def use_database(database):
+    '''Bind the graph models to another database and create the tables.'''
+    graph.db = database
+    graph.clear_caches()
+    for model in graph.MODELS:
+        model._meta.database = database
+    database.connect()
+    for model in graph.MODELS:
+        model.create_table(True)
+
+def random_resources(count, vocabulary_size=5000, entities_size=500):
+    '''Fake resources already enriched: [(resource, entities, stems), ...]'''
+    random.seed(42)
+    vocabulary = ['stem%d' % i for i in xrange(vocabulary_size)]
+    titles = ['Entity %d' % i for i in xrange(entities_size)]
+    resources = []
+    for i in xrange(count):
+        resource = graph.Resource(
+            social_network='BENCH',
+            external_id=str(i),
+            url='http://example.com/' + str(i),
+            raw_content='',
+            location_name=None,
+            location_lat=None,
+            location_lon=None
+        )
+        # zipf-like distribution of the words
+        stems = [vocabulary[int(random.paretovariate(1.) - 1) % vocabulary_size] for j in xrange(15)]
+        entities = [{'entity': random.choice(titles), 'rho': random.random()} for j in xrange(3)]
+        resources.append((resource, entities, stems))
+    return resources
+
+def count_rows(resources):
+    '''Resources plus stem and entity occurrences, whatever the number of link rows.'''
+    return sum(1 + len(entities) + len(stems) for resource, entities, stems in resources)
+
+def bench_ingestion(count=2000, batch_size=graph.INGESTION_BATCH_SIZE):
+    '''Rows per second written by save_resource (row by row) and write_resources (bulk).'''
+    use_database(SqliteDatabase(':memory:'))
+    resources = random_resources(count)
+    start = time.time()
+    for resource, entities, stems in resources:
+        graph.save_resource(resource, entities, stems)
+    elapsed = time.time() - start
+    print 'save_resource:   %d rows/s' % (count_rows(resources) / elapsed)
+
+    use_database(SqliteDatabase(':memory:'))
+    resources = random_resources(count)
+    start = time.time()
+    for i in xrange(0, count, batch_size):
+        graph.write_resources(resources[i:i + batch_size])
+    elapsed = time.time() - start
+    print 'write_resources: %d rows/s' % (count_rows(resources) / elapsed)
+
+# sample of captions and bios
+CAPTIONS = [
+    u'Sunday brunch at @dishoom with the best #chai in #London \U0001F60D\U0001F60D',
+    u'#nofilter #sunset over the Thames\n\nShot with my new camera \u2600\u2601',
+    u'Contact: JOHN.DOE@EXAMPLE.COM or @john_doe for bookings \u260E',
+    u'Photographer | London | \uff03travel \uff20someone\thttp://www.example.com',
+    u'  Best coffee in east london?   Ask me!  \r\n  @coffee.lover  ',
+    u'Le meilleur caf\xe9 de Paris, sans aucun doute #paris #caf\xe9',
+    u'\u20AC5 for a pint?! \u2764\u2764 #pub #shoreditch @@ ## @',
+    u'new post on the blog: www.myblog.co.uk/2014/03/best-brunch-spots \U0001F37A',
+    u'',
+    u'\t\t#\t@a\n',
+]
+
+# regexes of the previous implementation of resourceutil.sanitize_content
+MULTIPLE_SPACES_REGEX = re.compile('\s\s+')
+OTHER_THAN_SPACE_REGEX = re.compile('(\n|\t|\r)')
+HASHTAG_REGEX = re.compile(ur'#|\uff03')
+if sys.maxunicode > 0xffff:
+    # emoji regex (UCS-4 format)
+    EMOJI_REGEX = re.compile(u'[^\x00-\uffff]')
+else:
+    # emoji regex (UCS-2 format)
+    EMOJI_REGEX = re.compile(u'[\uD800-\uDBFF][\uDC00-\uDFFF]')
+# miscellaneous symbols regex
+MISC_SYMBOLS_REGEX = re.compile(u'[\u20A0-\u27BF]')
+
+def sequential_sanitize(content):
+    '''Previous implementation of resourceutil.sanitize_content: one pass per regex.'''
+    sane_content = content
+    sane_content = HASHTAG_REGEX.sub(' ', sane_content)
+    sane_content = resourceutil.USERNAME_REGEX.sub('', sane_content)
+    sane_content = resourceutil.EMAIL_REGEX.sub('', sane_content)
+    sane_content = EMOJI_REGEX.sub(' ', sane_content)
+    sane_content = MISC_SYMBOLS_REGEX.sub(' ', sane_content)
+    sane_content = sane_content.strip()
+    sane_content = OTHER_THAN_SPACE_REGEX.sub(' ', sane_content)
+    sane_content = MULTIPLE_SPACES_REGEX.sub(' ', sane_content)
+    sane_content = sane_content.lower()
+    return sane_content
+
+def bench_sanitize(repeat=20000):
+    '''Check sanitize_content against the sequential implementation and time both.
+       Exits with an error if they disagree.'''
+    for caption in CAPTIONS:
+        if resourceutil.sanitize_content(caption) != sequential_sanitize(caption):
+            sys.exit('different output for: ' + repr(caption))
+    for name, function in (('sequential', sequential_sanitize), ('fused', resourceutil.sanitize_content)):
+        start = time.time()
+        for i in xrange(repeat):
+            for caption in CAPTIONS:
+                function(caption)
+        elapsed = time.time() - start
+        print '%s: %.1f us per caption' % (name, elapsed * 1e6 / (repeat * len(CAPTIONS)))
+
+# captions labeled with their language: True for english
+LABELED_CAPTIONS = [
+    (u'Sunday brunch with the girls, best pancakes in town! #brunch #london', True),
+    (u'Can not wait for the weekend, off to the coast with my family \u2600', True),
+    (u'This is what happens when you leave me alone in a bakery', True),
+    (u'Throwback to our trip to Rome last summer, I miss it so much', True),
+    (u'Finally finished the painting I have been working on for weeks', True),
+    (u'Who else is watching the game tonight? @bob come over', True),
+    (u'New shoes, new me. Thank you @shoeshop for the amazing service', True),
+    (u'Rainy day in Manchester, perfect for a cup of tea and a good book', True),
+    (u'My favourite place to be on a Friday night #pub', True),
+    (u'Happy birthday to the best brother in the world! Love you', True),
+    (u'Some of the street art around Shoreditch, all of it is amazing', True),
+    (u'Getting ready for the marathon, only two weeks to go', True),
+    (u'Le meilleur caf\xe9 de Paris, sans aucun doute #paris', False),
+    (u'Une journ\xe9e magnifique au bord de la mer avec mes amis', False),
+    (u'Ich liebe diese Stadt, sie ist einfach wundersch\xf6n #berlin', False),
+    (u'Wir sind heute mit dem Fahrrad an den See gefahren', False),
+    (u'Que bonita es la playa en verano, no quiero volver a casa', False),
+    (u'Comiendo tapas con los amigos en el centro de Madrid', False),
+    (u'Una serata perfetta con la mia famiglia, che bello', False),
+    (u'Il tramonto sul mare \xe8 sempre una meraviglia #italia', False),
+    (u'Vamos para a praia com os amigos, o dia est\xe1 lindo', False),
+    (u'Wij zijn naar het strand geweest en het was heerlijk', False),
+    (u'Vi har det s\xe5 godt i sommerhuset i \xe5r', False),
+    (u'#selfie #instagood #photooftheday', False),
+]
+
+def bench_language(repeat=2000):
+    '''Accuracy and throughput of resourceutil.is_english on labeled captions,
+       on short captions and on captions followed by the content of a link.'''
+    def reference(text, sanitized=True):
+        # previous implementation: every word of the text
+        words = set(nltk.wordpunct_tokenize(text))
+        return len(words & resourceutil.english_stopwords()) > len(words & resourceutil.non_english_stopwords())
+
+    texts = [resourceutil.sanitize_content(caption) for caption, english in LABELED_CAPTIONS]
+    labels = [english for caption, english in LABELED_CAPTIONS]
+    # content extracted from a link is appended to the caption
+    long_texts = [text + ' ' + ' '.join(texts) * 10 for text in texts]
+    for name, function in (('reference', reference), ('is_english', resourceutil.is_english)):
+        verdicts = [function(text, sanitized=True) for text in texts]
+        correct = sum(1 for verdict, label in zip(verdicts, labels) if verdict == label)
+        print '%s: accuracy %.2f' % (name, float(correct) / len(texts))
+        for kind, sample in (('captions', texts), ('long texts', long_texts)):
+            start = time.time()
+            for i in xrange(repeat):
+                for text in sample:
+                    function(text, sanitized=True)
+            elapsed = time.time() - start
+            print '  %s: %d texts/s' % (kind, repeat * len(sample) / elapsed)
+
+def bench_lookup(sizes=(1000, 10000, 100000), lookups=1000):
+    '''Latency of the stem, user and resource lookups of the ingestion against the 
+       table size, with and without the indexes added by graphmanager.migrate_graph.'''
+    for size in sizes:
+        database = SqliteDatabase(':memory:')
+        use_database(database)
+        with database.transaction():
+            graph._insert_rows(graph.Stem, [{'stem': 'stem%d' % i} for i in xrange(size)])
+            graph._insert_rows(graph.User, [{'social_network': 'BENCH', 'external_id': i, 'username': str(i),
+                'url': '', 'completed': False} for i in xrange(size)])
+            graph._insert_rows(graph.Resource, [{'social_network': 'BENCH', 'external_id': str(i), 'url': '',
+                'raw_content': ''} for i in xrange(size)])
+        keys = [random.randrange(size) for i in xrange(lookups)]
+        queries = [
+            ('stem', lambda key: graph.Stem.select().where(graph.Stem.stem == 'stem%d' % key).first()),
+            ('user', lambda key: graph.User.select().where(
+                (graph.User.social_network == 'BENCH') & (graph.User.external_id == key)).first()),
+            ('resource', lambda key: graph.Resource.select().where(
+                (graph.Resource.social_network == 'BENCH') & (graph.Resource.external_id == str(key))).first()),
+        ]
+        timings = {}
+        for indexed in (True, False):
+            if not indexed:
+                database.drop_index(graph.Stem, [graph.Stem.stem])
+                database.drop_index(graph.User, [graph.User.social_network, graph.User.external_id])
+                database.drop_index(graph.Resource, [graph.Resource.social_network, graph.Resource.external_id])
+            for name, query in queries:
+                start = time.time()
+                for key in keys:
+                    query(key)
+                timings[(name, indexed)] = (time.time() - start) * 1e6 / lookups
+        print '%d rows: ' % size + ', '.join('%s %.0f us (%.0f us without index)' % (
+            name, timings[(name, True)], timings[(name, False)]) for name, query in queries)
+
+def bench_snapshot(count=20000, users=1000, queries=100):
+    '''Time to load the scoring indexes from the database and from a snapshot,
+       and latency of a query scored with each.'''
+    import shutil, tempfile, scoring, snapshot
+    use_database(SqliteDatabase(':memory:'))
+    graph.write_resources(random_resources(count))
+    with graph.db.transaction():
+        graph._insert_rows(graph.User, [{'social_network': 'BENCH', 'external_id': i, 'username': str(i),
+            'url': '', 'completed': True} for i in xrange(users)])
+        graph._insert_rows(graph.ResourceUser, [{'user': random.randint(1, users), 'resource': uid,
+            'distance': random.randint(0, 3)} for uid in xrange(1, count + 1) for j in xrange(3)])
+    query_terms = [(['stem%d' % random.randrange(50) for j in xrange(5)],
+        [{'entity': 'Entity %d' % random.randrange(500)}]) for i in xrange(queries)]
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        index = scoring.InvertedIndex().build()
+        scoring.UserIndex().build()
+        print 'database load: %.0f ms' % ((time.time() - start) * 1000)
+        start = time.time()
+        snapshot.export_snapshot(directory)
+        print 'snapshot export: %.0f ms' % ((time.time() - start) * 1000)
+        start = time.time()
+        snap = snapshot.Snapshot(directory)
+        snap.user_index()
+        print 'snapshot load: %.0f ms' % ((time.time() - start) * 1000)
+        for name, scorer in (('inverted index', index), ('snapshot', snap)):
+            start = time.time()
+            for query_stems, query_entities in query_terms:
+                scorer.score_resources(query_stems, query_entities)
+            print '%s: %.2f ms per query' % (name, (time.time() - start) * 1000 / queries)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_sharded(count=20000, users=5000, queries=10, shards=(1, 2, 4)):
+    '''End-to-end latency of the top users of a query and their ranked resources,
+       computed by a single process and by a ShardedScorer with several shards from
+       the same snapshot. The compute time of the slowest shard alone is the latency
+       to expect with one core per shard.'''
+    import shutil, tempfile, multiprocessing, snapshot, shardedscoring
+    use_database(SqliteDatabase(':memory:'))
+    resources = random_resources(count, vocabulary_size=500)
+    for resource, entities, stems in resources[::3]:
+        resource.location_name = 'London'
+    graph.write_resources(resources)
+    with graph.db.transaction():
+        graph._insert_rows(graph.User, [{'social_network': 'BENCH', 'external_id': i, 'username': str(i),
+            'url': '', 'completed': True} for i in xrange(users)])
+        graph._insert_rows(graph.ResourceUser, [{'user': random.randint(1, users), 'resource': uid,
+            'distance': random.randint(0, 3)} for uid in xrange(1, count + 1) for j in xrange(3)])
+    query_terms = [(['stem%d' % random.randrange(20) for j in xrange(5)],
+        [{'entity': 'Entity %d' % random.randrange(500)}]) for i in xrange(queries)]
+    directory = tempfile.mkdtemp()
+    try:
+        snapshot.export_snapshot(directory)
+        snap = snapshot.Snapshot(directory)
+        user_index = snap.user_index()
+        start = time.time()
+        for query_stems, query_entities in query_terms:
+            resource_scores = snap.score_resources(query_stems, query_entities)
+            for user_uid, score in user_index.top_users(resource_scores, 10):
+                user_index.best_resources(user_uid, resource_scores)
+        print 'single process: %.1f ms per query' % ((time.time() - start) * 1000 / queries)
+        print '%d cores' % multiprocessing.cpu_count()
+        for shard_count in shards:
+            slowest = 0.
+            for first_uid, last_uid in shardedscoring.uid_ranges(snap, shard_count):
+                shard = shardedscoring.Shard(snap, first_uid, last_uid)
+                start = time.time()
+                for query_stems, query_entities in query_terms:
+                    shard.score(query_stems, query_entities, 10)
+                slowest = max(slowest, time.time() - start)
+            scorer = shardedscoring.ShardedScorer(directory, shard_count).start()
+            try:
+                # wait until the shards are loaded
+                scorer.score(*query_terms[0])
+                start = time.time()
+                for query_stems, query_entities in query_terms:
+                    scorer.score(query_stems, query_entities, 10)
+                print '%d shards: %.1f ms per query, slowest shard alone %.1f ms' % (shard_count,
+                    (time.time() - start) * 1000 / queries, slowest * 1000 / queries)
+            finally:
+                scorer.close()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_topk(sizes=((20000, 5000), (200000, 20000)), k=10, queries=5):
+    '''Latency of UserIndex.top_users against the exhaustive score_users + nlargest,
+       on random graphs of (resources, users). Exits with an error if they disagree.'''
+    import heapq, scoring
+    from operator import itemgetter
+    random.seed(42)
+    for resource_count, user_count in sizes:
+        user_index = scoring.UserIndex()
+        for resource_uid in xrange(resource_count):
+            for j in xrange(3):
+                # a few users own most of the resources
+                user_uid = int(random.paretovariate(0.8)) % user_count
+                user_index.add(user_uid, resource_uid, random.randint(0, 3))
+        timings = {'top_users': 0., 'exhaustive': 0.}
+        for i in xrange(queries):
+            # scores of the resources matching a query: a long tail of small scores
+            resource_scores = dict((resource_uid, random.paretovariate(2.))
+                for resource_uid in random.sample(xrange(resource_count), resource_count / 2))
+            start = time.time()
+            top = user_index.top_users(resource_scores, k)
+            timings['top_users'] += time.time() - start
+            start = time.time()
+            exhaustive = heapq.nlargest(k, user_index.score_users(resource_scores).iteritems(), key=itemgetter(1))
+            timings['exhaustive'] += time.time() - start
+            if [round(score, 9) for user_uid, score in top] != [round(score, 9) for user_uid, score in exhaustive]:
+                sys.exit('top_users disagrees with the exhaustive scoring')
+        print '%d resources, %d users: top_users %.1f ms, exhaustive %.1f ms' % (resource_count, user_count,
+            timings['top_users'] * 1000 / queries, timings['exhaustive'] * 1000 / queries)
+
+def bench_parity(count=500, queries=20):
+    '''Check InvertedIndex.score_resources against answerquery.compute_resource_score
+       on a small SQLite graph, with repeated query terms and entities annotated
+       several times in a resource, and time both. Exits with an error if they disagree.'''
+    import answerquery, scoring
+    use_database(SqliteDatabase(':memory:'))
+    # few entities: most resources have an entity annotated twice or more
+    graph.write_resources(random_resources(count, vocabulary_size=50, entities_size=5))
+    resources = list(graph.Resource.select())
+    # a rebuild must not count the postings twice
+    index = scoring.InvertedIndex().build().build()
+    random.seed(42)
+    timings = {'compute_resource_score': 0., 'score_resources': 0.}
+    for i in xrange(queries):
+        query_stems = ['stem%d' % random.randrange(60) for j in xrange(4)]
+        query_stems.append(query_stems[0])
+        query_entities = [{'entity': 'Entity %d' % random.randrange(6)} for j in xrange(2)]
+        query_entities.append(query_entities[0])
+        graph.ResourceScore.delete().execute()
+        start = time.time()
+        irfs = answerquery.get_inverse_frequencies(query_stems, query_entities)
+        for resource in resources:
+            answerquery.compute_resource_score(resource, query_stems, query_entities, irfs)
+        timings['compute_resource_score'] += time.time() - start
+        expected = dict((uid, score) for uid, score in graph.ResourceScore
+            .select(graph.ResourceScore.resource, graph.ResourceScore.score).tuples() if score)
+        start = time.time()
+        scores = index.score_resources(query_stems, query_entities)
+        timings['score_resources'] += time.time() - start
+        scores = dict((uid, score) for uid, score in scores.iteritems() if score)
+        if sorted(expected) != sorted(scores) or any(abs(scores[uid] - score) > 1e-9 * max(1., abs(score))
+                for uid, score in expected.iteritems()):
+            sys.exit('score_resources disagrees with compute_resource_score for %r %r' % (query_stems, query_entities))
+    for name, elapsed in sorted(timings.iteritems()):
+        print '%s: %.1f ms per query' % (name, elapsed * 1000 / queries)
+
+IMPORT_SCRIPT = '''import time
+start = time.time()
+import %s
+imported = time.time()
+import resourceutil
+resourceutil.extract_stems(u'best coffee in london')
+print imported - start, time.time() - imported'''
+
+def bench_import(modules=('resourceutil', 'graphmanager', 'answerquery'), repeat=5):
+    '''Import time of the modules in a fresh interpreter, and time of the first
+       extract_stems call that loads what the import deferred.'''
+    for module in modules:
+        timings = [map(float, subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % module]).split())
+            for i in xrange(repeat)]
+        print '%s: import %.0f ms, first extract_stems %.0f ms' % (module,
+            min(timing[0] for timing in timings) * 1000, min(timing[1] for timing in timings) * 1000)
+
+BENCHMARKS = {
+    'ingestion': bench_ingestion,
+    'sanitize': bench_sanitize,
+    'language': bench_language,
+    'import': bench_import,
+    'lookup': bench_lookup,
+    'snapshot': bench_snapshot,
+    'sharded': bench_sharded,
+    'topk': bench_topk,
+    'parity': bench_parity,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print 'usage: python benchmark.py <' + '|'.join(sorted(BENCHMARKS)) + '>'
+    else:
+        BENCHMARKS[sys.argv[1]]()
@@ -1,14 +1,27 @@
 import time, peewee
 from random import randint
 import graphmanager as graph
+import ratelimit
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from frontier import Frontier
+from refresh import RefreshSchedule
+from enrichment import EnrichmentPipeline
+
+# number of users waiting for the writer per worker in run_concurrent
+QUEUED_USERS_PER_WORKER = 2
 
 class Crawler(object):
     '''Abstract class handling graph crawling.'''
     __metaclass__ = ABCMeta
 
-    def __init__(self, social_network):
+    def __init__(self, social_network, max_pages=None):
         self.social_network = social_network
+        # maximum number of pages of resources and of followees fetched per user
+        self.max_pages = max_pages
+        # optional enrichment.EnrichmentPipeline used to add resources to the graph
+        self.pipeline = None
 
     @abstractmethod
     def get_user_resources(self, user):
@@ -27,6 +40,41 @@ class Crawler(object):
             Must return a list of users or None.'''
         pass
 
+    def iter_user_resources(self, user):
+        '''Yield the resources of the user page by page, as lists of resources, 
+           at most max_pages of them. Crawlers of paginated APIs should override it
+           so that resources are ingested as pages arrive.'''
+        resources = self.get_user_resources(user)
+        if resources:
+            yield resources
+
+    def iter_user_followees(self, user):
+        '''Yield the people that this user follows page by page, as lists of users,
+           at most max_pages of them. Crawlers of paginated APIs should override it.'''
+        followees = self.get_user_followees(user)
+        if followees:
+            yield followees
+
+    def iter_new_user_resources(self, user, newest_resource=None):
+        '''Yield the pages of the resources published by the user since its last crawl.
+           Resources come newest first: paging stops at the high-water mark 
+           newest_resource (an external id) or at the first resource already in the graph.'''
+        for resources in self.iter_user_resources(user):
+            social_networks = set(resource.social_network for resource in resources)
+            known = set([newest_resource]) if newest_resource is not None else set()
+            for social_network in social_networks:
+                known.update(graph.known_external_ids(social_network, 
+                    [resource.external_id for resource in resources 
+                        if resource.social_network == social_network]))
+            new_resources = []
+            for resource in resources:
+                if str(resource.external_id) in known:
+                    if new_resources:
+                        yield new_resources
+                    return
+                new_resources.append(resource)
+            yield new_resources
+
     @abstractmethod
     def get_first_user(self):
         '''Get the first user to init the graph. Must return a user.'''
@@ -34,77 +82,171 @@ class Crawler(object):
 
     def run(self):
         '''Start the crawler.'''
-        # init graph
-        graph.init_graph()
+        # init graph and frontier
+        active_users = self.init_frontier()
 
         # init variables
-        firstRun = graph.is_first_run(self.social_network)
-        active_users = []
         loop = 0
         initial_time = int(round(time.time()))
 
         # start crawling
         while True:
-            if firstRun:
-                user = graph.add_user(self.get_first_user())
-                firstRun = False
-            else:
-                if len(active_users) == 0:
-                    user = graph.User.get(
-                        (graph.User.social_network == self.social_network) 
-                        & (graph.User.completed == False))
-                elif len(active_users) == 1:
-                    user = graph.User.get(
-                        (graph.User.social_network == self.social_network) 
-                        & (graph.User.completed == False)
-                        & (graph.User.uid != active_users[0].uid))
-                else:
-                    user = graph.User.get(
-                        (graph.User.social_network == self.social_network) 
-                        & (graph.User.completed == False)
-                        & (graph.User.uid != active_users[0].uid)
-                        & (graph.User.uid != active_users[1].uid))
+            user = self.next_user()
+            if user is None:
+                break # nothing left to crawl
 
             print 'current user: ' + user.username
 
+            # pages are ingested as they are fetched
+            self.ingest(active_users, user, self.get_user_profile(user), 
+                self.iter_user_resources(user), self.iter_user_followees(user))
 
-            active_users.insert(0, user)
+            # print statistics
+            graph.print_statistics()
+            ratelimit.print_statistics()
+            elapsed_time = int(round(time.time())) - initial_time
+            loop = loop + 1
+            print 'Avg. time to complete a loop: ' + str(round(elapsed_time / loop)) + ' seconds\n'
 
-            # get user profile
-            profile = self.get_user_profile(user)
-            # add it to the graph
-            if profile is not None:
-                resource = graph.add_resource(profile)
-                # map resource with active users
-                if resource is not None:
-                    graph.map_user_with_resource(active_users[0], resource, 0)
-                    if len(active_users) >= 2:
-                        graph.map_user_with_resource(active_users[1], resource, 1)
-                    if len(active_users) == 3:
-                        graph.map_user_with_resource(active_users[2], resource, 2)
-
-            # get all media from user and add them to the graph
-            resources = self.get_user_resources(user)
-            # map resources with active users
-            for res in resources:
-                resource = graph.add_resource(res)
-                if resource is not None:
-                    graph.map_user_with_resource(active_users[0], resource, 1)
-                    if len(active_users) >= 2:
-                        graph.map_user_with_resource(active_users[1], resource, 2)
+    def run_concurrent(self, workers=4, enrichment_concurrency=8):
+        '''Start the crawler with a pool of workers fetching users in parallel.
+           Only this thread writes to the graph, in the order users were dispatched,
+           so that active_users maps resources with the same distances as in run().
+           Resources are enriched with enrichment_concurrency concurrent API calls.'''
+        # init graph and frontier
+        active_users = self.init_frontier()
+
+        self.pipeline = EnrichmentPipeline(enrichment_concurrency)
+        pool = ThreadPool(workers)
+        # users dispatched to the workers: (user, result of fetch_user)
+        pending = deque()
+        loop = 0
+        initial_time = int(round(time.time()))
 
-            # get all people that this user follow and add them to the graph
-            for followee in self.get_user_followees(user):
-                graph.add_user(followee)
+        # start crawling
+        while True:
+            # keep the workers busy with the next users of the frontier
+            while len(pending) < workers * QUEUED_USERS_PER_WORKER:
+                user = self.next_user()
+                if user is None:
+                    break
+                pending.append((user, pool.apply_async(self.fetch_user, (user,))))
 
-            # oldest user in active_users is completed
-            if len(active_users) == 3:
-                old_user = active_users.pop()
-                old_user.completed = True
-                old_user.save()
+            if len(pending) == 0:
+                break # nothing left to crawl
+
+            user, result = pending.popleft()
+            print 'current user: ' + user.username
+            self.ingest(active_users, user, *result.get())
 
             # print statistics
             graph.print_statistics()
+            ratelimit.print_statistics()
             elapsed_time = int(round(time.time())) - initial_time
             loop = loop + 1
             print 'Avg. time to complete a loop: ' + str(round(elapsed_time / loop)) + ' seconds\n'
+
+        pool.close()
+        pool.join()
+        self.pipeline.close()
+        self.pipeline = None
+
+    def refresh(self, limit=None):
+        '''Incremental re-crawl: fetch the new resources of the users due for a refresh,
+           at most limit of them. Followees and profiles are not refreshed.'''
+        graph.init_graph()
+        self.schedule = RefreshSchedule(self.social_network)
+        self.schedule.seed()
+
+        initial_time = int(round(time.time()))
+        refreshed = 0
+        for mark in self.schedule.due(limit):
+            user = mark.user
+            print 'refreshing user: ' + user.username
+
+            newest_resource = None
+            new_resources = 0
+            for resources in self.iter_new_user_resources(user, mark.newest_resource):
+                if newest_resource is None and resources:
+                    newest_resource = resources[0].external_id
+                new_resources = new_resources + len(resources)
+                for resource in graph.add_resources(resources, pipeline=self.pipeline):
+                    if resource is not None:
+                        graph.map_user_with_resource(user, resource, 1)
+            self.schedule.update(user, newest_resource, new_resources)
+            print str(new_resources) + ' new resources\n'
+            refreshed = refreshed + 1
+
+        # print statistics
+        graph.print_statistics()
+        ratelimit.print_statistics()
+        elapsed_time = int(round(time.time())) - initial_time
+        print 'Refreshed ' + str(refreshed) + ' users in ' + str(elapsed_time) + ' seconds\n'
+
+    def init_frontier(self):
+        '''Init the graph and the crawl frontier, seeded with the first user on the 
+           first run. Returns the active users of the last checkpoint.'''
+        graph.init_graph()
+        self.frontier = Frontier(self.social_network)
+        self.schedule = RefreshSchedule(self.social_network)
+        if graph.is_first_run(self.social_network):
+            self.frontier.push([graph.add_user(self.get_first_user())], 0)
+        self.frontier.seed()
+        return self.frontier.resume()
+
+    def next_user(self):
+        '''Get the next user to crawl from the frontier, None if there is none.'''
+        return self.frontier.pop()
+
+    def fetch_user(self, user):
+        '''Get the profile, the pages of resources and the pages of followees of a user 
+           from the social network. Does not access the graph, can be called from any thread.'''
+        return (self.get_user_profile(user), list(self.iter_user_resources(user)),
+            list(self.iter_user_followees(user)))
+
+    def ingest(self, active_users, user, profile, resource_pages, followee_pages):
+        '''Add the fetched data of a user to the graph, resources and followees page by
+           page. active_users holds the last crawled users, most recent first: their 
+           resources are mapped with the current user at a distance growing with their 
+           position.'''
+        active_users.insert(0, user)
+
+        # add user profile to the graph
+        if profile is not None:
+            resource = graph.add_resource(profile)
+            # map resource with active users
+            if resource is not None:
+                graph.map_user_with_resource(active_users[0], resource, 0)
+                if len(active_users) >= 2:
+                    graph.map_user_with_resource(active_users[1], resource, 1)
+                if len(active_users) == 3:
+                    graph.map_user_with_resource(active_users[2], resource, 2)
+
+        # add all media from user to the graph and map them with active users
+        newest_resource = None
+        new_resources = 0
+        for resources in resource_pages:
+            if newest_resource is None and resources:
+                newest_resource = resources[0].external_id
+            new_resources = new_resources + len(resources)
+            for resource in graph.add_resources(resources, pipeline=self.pipeline):
+                if resource is not None:
+                    graph.map_user_with_resource(active_users[0], resource, 1)
+                    if len(active_users) >= 2:
+                        graph.map_user_with_resource(active_users[1], resource, 2)
+
+        # add all people that this user follow to the graph and to the frontier
+        depth = self.frontier.depth(user) + 1
+        for followees in followee_pages:
+            self.frontier.push([graph.add_user(followee) for followee in followees], depth)
+
+        # high-water mark for the incremental re-crawl
+        self.schedule.update(user, newest_resource, new_resources)
+
+        # oldest user in active_users is completed
+        if len(active_users) == 3:
+            old_user = active_users.pop()
+            old_user.completed = True
+            old_user.save()
+            self.frontier.complete(old_user)
+        self.frontier.checkpoint(active_users)
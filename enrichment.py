@@ -0,0 +1,36 @@
+import resourceutil
+import graphmanager as graph
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+class EnrichmentPipeline(object):
+    '''Enrichment stage between the crawler and the graph writer: the URL content and 
+       the entities of several resources are fetched concurrently (AlchemyAPI, TAGME) 
+       through a pooled HTTP session, while results come out in input order.'''
+
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+        self.pool = ThreadPool(concurrency)
+        resourceutil.configure_http_pool(concurrency)
+
+    def stream(self, resources):
+        '''Enrich an iterable of resources with at most concurrency of them in flight.
+           Yields (resource, prepared) where prepared is the output of 
+           graphmanager.prepare_resource: (entities, stems) or None.'''
+        pending = deque()
+        for resource in resources:
+            pending.append((resource, self.pool.apply_async(graph.prepare_resource, (resource,))))
+            if len(pending) >= self.concurrency:
+                resource, result = pending.popleft()
+                yield resource, result.get()
+        while pending:
+            resource, result = pending.popleft()
+            yield resource, result.get()
+
+    def prepare(self, resources):
+        '''Enrich a list of resources, returns the list of prepared results.'''
+        return [prepared for resource, prepared in self.stream(resources)]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
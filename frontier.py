@@ -0,0 +1,112 @@
+import datetime
+import graphmanager as graph
+from peewee import SQL
+
+# states of a FrontierEntry
+PENDING = 0
+ACTIVE = 1
+DONE = 2
+
+class Frontier(object):
+    '''Persistent crawl frontier of a social network, stored in the FrontierEntry table.
+       Users are dequeued by increasing BFS depth through an index, and the window of
+       active users is checkpointed so that a crawl resumes cleanly after a crash.'''
+
+    def __init__(self, social_network):
+        self.social_network = social_network
+
+    def seed(self):
+        '''Fill the frontier with the users of a graph crawled before the frontier
+           existed. Does nothing if the frontier is not empty.'''
+        if self._query().exists():
+            return
+        for completed, state in ((False, PENDING), (True, DONE)):
+            graph.FrontierEntry.insert_from(
+                [graph.FrontierEntry.user, graph.FrontierEntry.social_network,
+                    graph.FrontierEntry.depth, graph.FrontierEntry.state],
+                graph.User
+                    .select(graph.User.uid, graph.User.social_network, SQL('0'), SQL(str(state)))
+                    .where(
+                        (graph.User.social_network == self.social_network)
+                        & (graph.User.completed == completed))
+            ).execute()
+
+    def push(self, users, depth):
+        '''Queue users found at the given BFS depth. Users already in the frontier,
+           including the completed ones, are ignored.'''
+        rows = [{
+            'user': user.uid,
+            'social_network': self.social_network,
+            'depth': depth,
+            'state': PENDING
+        } for user in users]
+        for i in xrange(0, len(rows), graph.INSERT_BATCH_SIZE):
+            graph.insert_ignore(graph.FrontierEntry.insert_many(rows[i:i + graph.INSERT_BATCH_SIZE]))
+
+    def pop(self):
+        '''Dequeue the pending user with the lowest depth and mark it active.
+           Returns None when there is no pending user.'''
+        while True:
+            entry = (self._query()
+                .where(graph.FrontierEntry.state == PENDING)
+                .order_by(graph.FrontierEntry.depth, graph.FrontierEntry.uid)
+                .first())
+            if entry is None:
+                return None
+            # another crawler may have taken it in the meantime
+            taken = (graph.FrontierEntry
+                .update(state=ACTIVE)
+                .where((graph.FrontierEntry.uid == entry.uid) & (graph.FrontierEntry.state == PENDING))
+                .execute())
+            if taken:
+                return graph.User.get(graph.User.uid == entry.user_id)
+
+    def depth(self, user):
+        '''BFS depth of a user of the frontier.'''
+        return (graph.FrontierEntry
+            .select(graph.FrontierEntry.depth)
+            .where(graph.FrontierEntry.user == user.uid)
+            .get()
+            .depth)
+
+    def complete(self, user):
+        graph.FrontierEntry.update(state=DONE).where(graph.FrontierEntry.user == user.uid).execute()
+
+    def checkpoint(self, active_users):
+        '''Save the window of active users, most recent first.'''
+        active_users = ','.join(str(user.uid) for user in active_users)
+        updated = (graph.CrawlCheckpoint
+            .update(active_users=active_users, updated=datetime.datetime.now())
+            .where(graph.CrawlCheckpoint.social_network == self.social_network)
+            .execute())
+        if not updated:
+            graph.CrawlCheckpoint.create(social_network=self.social_network, active_users=active_users)
+
+    def resume(self):
+        '''Restore the window of active users of the last checkpoint and queue again
+           the users that were being crawled but not checkpointed.
+           Returns the active users, most recent first.'''
+        active_users = []
+        checkpoint = (graph.CrawlCheckpoint
+            .select()
+            .where(graph.CrawlCheckpoint.social_network == self.social_network)
+            .first())
+        if checkpoint is not None and checkpoint.active_users:
+            uids = [int(uid) for uid in checkpoint.active_users.split(',')]
+            users = dict((user.uid, user) for user in graph.User.select().where(graph.User.uid << uids))
+            active_users = [users[uid] for uid in uids if uid in users and not users[uid].completed]
+
+        query = graph.FrontierEntry.update(state=PENDING).where(
+            (graph.FrontierEntry.social_network == self.social_network)
+            & (graph.FrontierEntry.state == ACTIVE))
+        if active_users:
+            query = query.where(~(graph.FrontierEntry.user << [user.uid for user in active_users]))
+        query.execute()
+        return active_users
+
+    def _query(self):
+        return graph.FrontierEntry.select().where(graph.FrontierEntry.social_network == self.social_network)
+
+    def size(self):
+        '''Number of pending users.'''
+        return self._query().where(graph.FrontierEntry.state == PENDING).count()
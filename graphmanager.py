@@ -1,11 +1,36 @@
-import re
+import os, re, sys, datetime, operator, multiprocessing
 import resourceutil
 from peewee import *
+from playhouse.pool import PooledMySQLDatabase
+from lrucache import LRUCache
+from playhouse.migrate import MySQLMigrator, migrate
 
 # pattern to match some unicode characters non recognized by mysql
 SANITIZE_UNICODE = re.compile(u'[^\u0000-\uD7FF\uE000-\uFFFF]', re.UNICODE)
 
-db = MySQLDatabase('expertfinding', host='127.0.0.1', user='root', passwd='')
+# number of resources per batch in add_resources
+INGESTION_BATCH_SIZE = 100
+# number of rows per multi-row INSERT
+INSERT_BATCH_SIZE = 1000
+
+# maximum number of entries of each id cache
+CACHE_SIZE = 100000
+
+def create_database():
+    '''MySQL database of the graph, configured by the EXPERTFINDING_DB_* environment
+       variables. Connections are pooled and each thread uses its own connection: 
+       threads should call db.close() when done to give it back to the pool.'''
+    return PooledMySQLDatabase(
+        os.environ.get('EXPERTFINDING_DB_NAME', 'expertfinding'),
+        host=os.environ.get('EXPERTFINDING_DB_HOST', '127.0.0.1'),
+        port=int(os.environ.get('EXPERTFINDING_DB_PORT', 3306)),
+        user=os.environ.get('EXPERTFINDING_DB_USER', 'root'),
+        passwd=os.environ.get('EXPERTFINDING_DB_PASSWORD', ''),
+        max_connections=int(os.environ.get('EXPERTFINDING_DB_MAX_CONNECTIONS', 20)),
+        # recycle connections before MySQL closes them (wait_timeout)
+        stale_timeout=int(os.environ.get('EXPERTFINDING_DB_STALE_TIMEOUT', 300)))
+
+db = create_database()
 
 class BaseModel(Model):
     class Meta:
@@ -17,7 +42,12 @@ class User(BaseModel):
     username = CharField()
     url = CharField()
     social_network = CharField()
-    completed = BooleanField()
+    completed = BooleanField(index=True)
+
+    class Meta:
+        indexes = (
+            (('social_network', 'external_id'), True),
+        )
 
 class Resource(BaseModel):
     uid = PrimaryKeyField()
@@ -29,6 +59,11 @@ class Resource(BaseModel):
     location_lat = FloatField(null=True)
     location_lon = FloatField(null=True)
 
+    class Meta:
+        indexes = (
+            (('social_network', 'external_id'), True),
+        )
+
 class ResourceUser(BaseModel):
     '''Intermediary table for many to many relationship between Resource and User.
        Contains a distance between the resource and the user.'''
@@ -38,26 +73,44 @@ class ResourceUser(BaseModel):
     distance = IntegerField()
 
 class Stem(BaseModel):
+    '''doc_freq is the number of occurrences of the stem: sum of ResourceStem.tf.'''
     uid = PrimaryKeyField()
-    stem = CharField()
+    stem = CharField(unique=True)
+    doc_freq = IntegerField(default=0)
 
 class Entity(BaseModel):
+    '''doc_freq is the number of occurrences of the entity: sum of ResourceEntity.count.'''
     uid = PrimaryKeyField()
-    entity = CharField()
+    entity = CharField(unique=True)
+    doc_freq = IntegerField(default=0)
 
 class ResourceStem(BaseModel):
-    '''Intermediary table for many to many relationship between Resource and Stem'''
+    '''Intermediary table for many to many relationship between Resource and Stem.
+       One row per stem of a resource, tf is its number of occurrences.'''
     uid = PrimaryKeyField()
     stem = ForeignKeyField(Stem)
     resource = ForeignKeyField(Resource)
+    tf = IntegerField(default=1)
+
+    class Meta:
+        indexes = (
+            (('resource', 'stem'), True),
+        )
 
 class ResourceEntity(BaseModel):
     '''Intermediary table for many to many relationship between Resource and Entity.
-       Contains a weight rho used for entity score calculation. '''
+       One row per entity of a resource: count is its number of annotations and
+       rho_sum the sum of their weights rho, used for entity score calculation.'''
     uid = PrimaryKeyField()
     entity = ForeignKeyField(Entity)
     resource = ForeignKeyField(Resource)
-    rho = FloatField()
+    count = IntegerField(default=1)
+    rho_sum = FloatField()
+
+    class Meta:
+        indexes = (
+            (('resource', 'entity'), True),
+        )
 
 class UserScore(BaseModel):
     uid = PrimaryKeyField()
@@ -69,95 +122,634 @@ class ResourceScore(BaseModel):
     score = FloatField()
     resource = ForeignKeyField(Resource, related_name='scores')
 
+class ExpertQuery(BaseModel):
+    '''A query answered by answerquery.answer, scopes the persisted scores.'''
+    uid = PrimaryKeyField()
+    text = TextField()
+    created = DateTimeField(default=datetime.datetime.now)
+
+class QueryUserScore(BaseModel):
+    uid = PrimaryKeyField()
+    query = ForeignKeyField(ExpertQuery, related_name='user_scores')
+    owner = ForeignKeyField(User)
+    score = FloatField()
+
+class QueryResourceScore(BaseModel):
+    uid = PrimaryKeyField()
+    query = ForeignKeyField(ExpertQuery, related_name='resource_scores')
+    resource = ForeignKeyField(Resource)
+    score = FloatField()
+
+class FrontierEntry(BaseModel):
+    '''Crawl queue: one row per user, pending users are crawled by increasing BFS depth.
+       See frontier.Frontier.'''
+    uid = PrimaryKeyField()
+    user = ForeignKeyField(User, unique=True)
+    social_network = CharField()
+    depth = IntegerField()
+    state = IntegerField()
+
+    class Meta:
+        indexes = (
+            # dequeue the next pending user without scanning
+            (('social_network', 'state', 'depth', 'uid'), False),
+        )
+
+class CrawlCheckpoint(BaseModel):
+    '''Last window of active users of a crawler (comma separated uids, most recent first).'''
+    uid = PrimaryKeyField()
+    social_network = CharField(unique=True)
+    active_users = TextField()
+    updated = DateTimeField(default=datetime.datetime.now)
+
+class UserRefresh(BaseModel):
+    '''High-water mark of a crawled user for the incremental re-crawl: external id of 
+       its newest resource, time of the last crawl and of the next refresh.
+       See refresh.RefreshSchedule.'''
+    uid = PrimaryKeyField()
+    user = ForeignKeyField(User, unique=True)
+    social_network = CharField()
+    newest_resource = CharField(null=True)
+    last_crawled = DateTimeField(null=True)
+    next_refresh = DateTimeField()
+
+    class Meta:
+        indexes = (
+            # users due for a refresh without scanning
+            (('social_network', 'next_refresh'), False),
+        )
+
+class SchemaMigration(BaseModel):
+    '''Schema migrations already applied to the graph, see migrate_graph.'''
+    uid = PrimaryKeyField()
+    name = CharField(unique=True)
+    applied = DateTimeField(default=datetime.datetime.now)
+
+# columns written by write_resources
+RESOURCE_FIELDS = [field for field in Resource._meta.sorted_fields if field.name != 'uid']
+
+# in-process caches of the uids of stems, entities and users:
+# stem -> uid, entity title -> uid, (social_network, external_id) -> uid
+STEM_CACHE = LRUCache(CACHE_SIZE)
+ENTITY_CACHE = LRUCache(CACHE_SIZE)
+USER_CACHE = LRUCache(CACHE_SIZE)
+
+def configure_caches(size):
+    '''Change the maximum number of entries of the id caches.'''
+    for cache in (STEM_CACHE, ENTITY_CACHE, USER_CACHE):
+        cache.resize(size)
+
+# functions called without arguments after resources or links are written
+INGEST_LISTENERS = []
+
+def on_ingest(listener):
+    '''Call listener() whenever this process writes resources or links to the graph,
+       e.g. to invalidate a cache of query answers.'''
+    INGEST_LISTENERS.append(listener)
+
+def remove_ingest_listener(listener):
+    '''Stop calling a listener added with on_ingest.'''
+    if listener in INGEST_LISTENERS:
+        INGEST_LISTENERS.remove(listener)
+
+def notify_ingest():
+    for listener in INGEST_LISTENERS:
+        listener()
+
+def clear_caches():
+    '''Empty the id caches, e.g. after rows were deleted out of this process.'''
+    for cache in (STEM_CACHE, ENTITY_CACHE, USER_CACHE):
+        cache.clear()
+
+# all the tables of the graph
+MODELS = [User, Resource, ResourceUser, Stem, Entity, ResourceStem, ResourceEntity, 
+    UserScore, ResourceScore, ExpertQuery, QueryUserScore, QueryResourceScore,
+    FrontierEntry, CrawlCheckpoint, UserRefresh, SchemaMigration]
+
 def init_graph():
     # connect to the database
     db.connect()
 
     # create tables if necessary
-    User.create_table(True)
-    Resource.create_table(True)
-    ResourceUser.create_table(True)
-    Stem.create_table(True)
-    Entity.create_table(True)
-    ResourceStem.create_table(True)
-    ResourceEntity.create_table(True)
-    UserScore.create_table(True)
-    ResourceScore.create_table(True)
+    for model in MODELS:
+        model.create_table(True)
+
+    # bring the tables created by older versions up to date
+    migrate_graph()
+
+def migrate_graph():
+    '''Apply the schema migrations that were not applied yet, in order.
+       Migrations are idempotent: tables created after a migration was written
+       already have its columns and indexes.'''
+    SchemaMigration.create_table(True)
+    applied = set(name for (name,) in SchemaMigration.select(SchemaMigration.name).tuples())
+    for name, migration in MIGRATIONS:
+        if name not in applied:
+            migration()
+            SchemaMigration.create(name=name)
+
+def _migrate_doc_freq():
+    '''Add and fill the doc_freq columns of Stem and Entity.'''
+    columns = [column.name for model in (Stem, Entity) for column in db.get_columns(model._meta.db_table)]
+    if columns.count('doc_freq') < 2:
+        rebuild_doc_freq()
+
+def _migrate_unique_terms():
+    '''Merge the duplicated stems and entities and make them unique.'''
+    merged = _merge_duplicates(Stem, [Stem.stem], [ResourceStem.stem])
+    merged = merged + _merge_duplicates(Entity, [Entity.entity], [ResourceEntity.entity])
+    if merged:
+        rebuild_doc_freq()
+    _add_index(Stem, [Stem.stem], unique=True)
+    _add_index(Entity, [Entity.entity], unique=True)
+
+def _migrate_unique_users():
+    '''Merge the duplicated users, make (social_network, external_id) unique and
+       index completed.'''
+    _merge_duplicates(User, [User.social_network, User.external_id],
+        [ResourceUser.user, UserScore.owner, QueryUserScore.owner],
+        [FrontierEntry.user, UserRefresh.user])
+    _add_index(User, [User.social_network, User.external_id], unique=True)
+    _add_index(User, [User.completed])
+
+def _migrate_unique_resources():
+    '''Merge the duplicated resources and make (social_network, external_id) unique.
+       The links to stems and entities of a duplicate are dropped: the kept resource
+       has the same content and already has them.'''
+    merged = _merge_duplicates(Resource, [Resource.social_network, Resource.external_id],
+        [ResourceUser.resource],
+        [ResourceStem.resource, ResourceEntity.resource, ResourceScore.resource, QueryResourceScore.resource])
+    if merged:
+        rebuild_doc_freq()
+    _add_index(Resource, [Resource.social_network, Resource.external_id], unique=True)
+
+def _migrate_aggregate_links():
+    '''Replace the rows of ResourceStem and ResourceEntity, one per occurrence, with 
+       one row per (resource, term) holding the aggregated counts.'''
+    q = db.quote_char
+    _aggregate_links(ResourceStem, 'tf', ['stem_id', 'resource_id', 'tf'],
+        'SELECT stem_id, resource_id, COUNT(*) AS tf FROM %s GROUP BY stem_id, resource_id')
+    _aggregate_links(ResourceEntity, 'count', ['entity_id', 'resource_id', q + 'count' + q, 'rho_sum'],
+        'SELECT entity_id, resource_id, COUNT(*) AS ' + q + 'count' + q + ', SUM(rho) AS rho_sum '
+        'FROM %s GROUP BY entity_id, resource_id')
+    rebuild_doc_freq()
+
+def _aggregate_links(model, aggregate_column, columns, aggregate_sql):
+    '''Rebuild a link table from aggregate_sql run on its old rows, unless it already
+       has aggregate_column. The aggregated rows go through a temporary table, kept 
+       until copied back so that an interrupted migration can be run again.'''
+    table = model._meta.db_table
+    temporary_table = table + '_aggregated'
+    if temporary_table not in db.get_tables():
+        if aggregate_column in [column.name for column in db.get_columns(table)]:
+            return # already aggregated
+        db.execute_sql('CREATE TABLE %s AS %s' % (temporary_table, aggregate_sql % table))
+    if aggregate_column not in [column.name for column in db.get_columns(table)]:
+        db.execute_sql('DROP TABLE %s' % table)
+    model.create_table(True)
+    if not model.select().exists():
+        db.execute_sql('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            table, ', '.join(columns), ', '.join(columns), temporary_table))
+    db.execute_sql('DROP TABLE %s' % temporary_table)
+
+# schema migrations, in order: (name, function)
+MIGRATIONS = [
+    ('doc_freq', _migrate_doc_freq),
+    ('unique_terms', _migrate_unique_terms),
+    ('unique_users', _migrate_unique_users),
+    ('unique_resources', _migrate_unique_resources),
+    ('aggregate_links', _migrate_aggregate_links),
+]
+
+def _merge_duplicates(model, fields, references, dependents=()):
+    '''Keep the row with the lowest uid of each group of rows sharing the same fields:
+       foreign keys of references are pointed to it, rows of dependents referencing 
+       another row of the group are deleted, then the other rows.
+       Returns the number of rows deleted from model.'''
+    merged = 0
+    duplicates = (model
+        .select(*fields)
+        .group_by(*fields)
+        .having(fn.COUNT(model.uid) > 1)
+        .tuples())
+    for values in list(duplicates):
+        condition = reduce(operator.and_, [field == value for field, value in zip(fields, values)])
+        uids = sorted(uid for (uid,) in model.select(model.uid).where(condition).tuples())
+        kept, others = uids[0], uids[1:]
+        for field in references:
+            field.model_class.update(**{field.name: kept}).where(field << others).execute()
+        for field in dependents:
+            field.model_class.delete().where(field << others).execute()
+        model.delete().where(model.uid << others).execute()
+        merged = merged + len(others)
+    return merged
+
+def _add_index(model, fields, unique=False):
+    '''Create an index, unless the table was created with it.'''
+    database = model._meta.database
+    name = database.compiler().index_name(model._meta.db_table, [field.db_column for field in fields])
+    if name not in [index.name for index in database.get_indexes(model._meta.db_table)]:
+        database.create_index(model, fields, unique)
+
+def insert_ignore(query):
+    '''Execute an insert or insert_many query, skipping the rows that would violate a 
+       unique index. Returns the number of rows inserted.
+       peewee's on_conflict('IGNORE') only produces the SQLite syntax.'''
+    database = query.model_class._meta.database
+    sql, params = query.sql()
+    if isinstance(database, MySQLDatabase):
+        sql = 'INSERT IGNORE' + sql[len('INSERT'):]
+    else:
+        sql = 'INSERT OR IGNORE' + sql[len('INSERT'):]
+    return database.execute_sql(sql, params).rowcount
 
 def is_first_run(social_network):
     '''Check if there is at least one user in the graph. If yes, return false.'''
     return User.select().where(User.social_network == social_network).count() == 0
 
 def add_user(user):
-    # add user to the db
-    query = User.select().where((User.social_network == user.social_network) & (User.external_id == user.external_id))
-    if not query.exists():
-        # persist
-        user.save()
+    '''Add a user to the graph if it is not there yet and return the stored user.
+       When the user is found in USER_CACHE, the given instance is returned with 
+       the uid of the stored row: reload it before relying on completed.'''
+    key = (user.social_network, str(user.external_id))
+    uid = USER_CACHE.get(key)
+    if uid is not None:
+        user.uid = uid
         return user
-    else:
-        # return user from db
-        return query.get()
+
+    # add user to the db, the unique index settles concurrent insertions
+    query = User.select().where((User.social_network == user.social_network) & (User.external_id == user.external_id))
+    stored = query.first()
+    if stored is None:
+        insert_ignore(User.insert(**_row(user)))
+        stored = query.get()
+    USER_CACHE.put(key, stored.uid)
+    return stored
 
 def add_resource(resource):
+    stored = Resource.select().where(
+        (Resource.social_network == resource.social_network) & (Resource.external_id == resource.external_id)).first()
+    if stored is None:
+        prepared = prepare_resource(resource)
+        if prepared is None:
+            return None # resource not in English, return None
+        entities, stems = prepared
+        # the resource and its links are committed together
+        try:
+            with db.atomic():
+                stored = save_resource(resource, entities, stems)
+        except:
+            # the caches may hold uids of terms rolled back
+            clear_caches()
+            raise
+        notify_ingest()
+        return stored # return newly created resource
+    else:
+        return stored # return resource from the db
+
+def known_external_ids(social_network, external_ids):
+    '''External ids of the resources of a social network already in the graph.'''
+    if not external_ids:
+        return set()
+    query = (Resource
+        .select(Resource.external_id)
+        .where((Resource.social_network == social_network) 
+            & (Resource.external_id << [str(external_id) for external_id in external_ids]))
+        .tuples())
+    return set(external_id for (external_id,) in query)
+
+def prepare_resource(resource):
+    '''Clean up a resource and extract its entities and stems.
+       Returns (entities, stems), or None if the resource is not in English.'''
+    # remove invalid Unicode characters with a white square to avoid errors while persisting
+    resource.raw_content = re.sub(SANITIZE_UNICODE, u'\u25FD', resource.raw_content)
+
+    if resource.location_name is not None:
+        resource.location_name = re.sub(SANITIZE_UNICODE, u'\u25FD', resource.location_name)
+
+    # extract content from (eventual) http links, replace links with actual content
+    content = resourceutil.extract_content_from_url(resource.raw_content)
+
+    # sanitize once for language detection, entities and stems
+    sane_content = resourceutil.sanitize_content(content)
+
+    # check wether the resource is in english before persisting it
+    if not resourceutil.is_english(sane_content, sanitized=True):
+        return None
+
+    return (resourceutil.extract_entities(sane_content, sanitized=True), 
+        resourceutil.extract_stems(sane_content, sanitized=True))
+
+def save_resource(resource, entities, stems):
+    '''Persist a resource and link it with its entities and stems, row by row.
+       Returns the stored resource: the given one, or the row another writer 
+       persisted in the meantime (then left as it is).'''
+    # persist resource
     query = Resource.select().where(
         (Resource.social_network == resource.social_network) & (Resource.external_id == resource.external_id))
-    if not query.exists():
-        # remove invalid Unicode characters with a white square to avoid errors while persisting
-        resource.raw_content = re.sub(SANITIZE_UNICODE, u'\u25FD', resource.raw_content)
+    if not insert_ignore(Resource.insert(**_row(resource))):
+        return query.get()
+    resource.uid = query.get().uid
 
-        if resource.location_name is not None:
-            resource.location_name = re.sub(SANITIZE_UNICODE, u'\u25FD', resource.location_name)
+    # entities: number of annotations and sum of rho of each entity
+    entity_freqs = {}
+    rho_sums = {}
+    for entity in entities:
+        entity_uid = _get_or_create_term(Entity, Entity.entity, ENTITY_CACHE, entity['entity'])
+        entity_freqs[entity_uid] = entity_freqs.get(entity_uid, 0) + 1
+        rho_sums[entity_uid] = rho_sums.get(entity_uid, 0.) + entity['rho']
+    for entity_uid, count in entity_freqs.iteritems():
+        # map resource and entity
+        ResourceEntity(
+            entity = entity_uid,
+            resource = resource,
+            count = count,
+            rho_sum = rho_sums[entity_uid]
+        ).save()
+    increment_doc_freq(Entity, entity_freqs)
 
-        # extract content from (eventual) http links, replace links with actual content
-        content = resourceutil.extract_content_from_url(resource.raw_content)
+    # stems: term frequency of each stem
+    stem_freqs = {}
+    for stem in stems:
+        stem_uid = _get_or_create_term(Stem, Stem.stem, STEM_CACHE, stem)
+        stem_freqs[stem_uid] = stem_freqs.get(stem_uid, 0) + 1
+    for stem_uid, tf in stem_freqs.iteritems():
+        # map resource and stem
+        ResourceStem(
+            stem = stem_uid,
+            resource = resource,
+            tf = tf
+        ).save()
+    increment_doc_freq(Stem, stem_freqs)
+    return resource
 
-        # check wether the resource is in english before persisting it
-        if resourceutil.is_english(content):
-            # persist resource
-            resource.save()
+def _get_or_create_term(model, field, cache, term):
+    '''uid of a stem or entity, created if it does not exist yet.'''
+    uid = cache.get(term)
+    if uid is None:
+        query = model.select(model.uid).where(field == term)
+        stored = query.first()
+        if stored is None:
+            # term does not exist yet
+            insert_ignore(model.insert(**{field.name: term}))
+            stored = query.get()
+        uid = stored.uid
+        cache.put(term, uid)
+    return uid
 
-            # entities
-            entities = resourceutil.extract_entities(content)
-            for entity in entities:
-                entity_query = Entity.select().where(Entity.entity == entity['entity'])
-                if not entity_query.exists():
-                    # entity does not exist yet
-                    entity_object = Entity(entity=entity['entity'])
-                    entity_object.save()
+def add_resources(resources, batch_size=INGESTION_BATCH_SIZE, pipeline=None):
+    '''Batched version of add_resource: existing resources are looked up once per 
+       batch and new ones are persisted in bulk by write_resources.
+       New resources are enriched by pipeline (an enrichment.EnrichmentPipeline) if given.
+       Returns a list aligned with resources (None for resources not in English).'''
+    results = []
+    for i in xrange(0, len(resources), batch_size):
+        batch = resources[i:i + batch_size]
+
+        # one lookup for the resources already in the graph
+        known = {}
+        for social_network in set(resource.social_network for resource in batch):
+            external_ids = [str(resource.external_id) for resource in batch 
+                if resource.social_network == social_network]
+            for resource in Resource.select().where(
+                (Resource.social_network == social_network) & (Resource.external_id << external_ids)):
+                known[(social_network, resource.external_id)] = resource
+
+        # new resources, the same resource can appear twice in a batch
+        new_resources = []
+        for resource in batch:
+            key = (resource.social_network, str(resource.external_id))
+            if key not in known:
+                known[key] = resource
+                new_resources.append(resource)
+
+        # enrich new resources
+        if pipeline is not None:
+            prepared_resources = pipeline.prepare(new_resources)
+        else:
+            prepared_resources = [prepare_resource(resource) for resource in new_resources]
+        writes = []
+        for resource, prepared in zip(new_resources, prepared_resources):
+            if prepared is None:
+                known[(resource.social_network, str(resource.external_id))] = None
+            else:
+                writes.append((resource, prepared[0], prepared[1]))
+
+        for resource in write_resources(writes):
+            known[(resource.social_network, str(resource.external_id))] = resource
+        results.extend(known[(resource.social_network, str(resource.external_id))] for resource in batch)
+    return results
+
+def write_resources(prepared_resources):
+    '''Persist [(resource, entities, stems), ...] in one transaction with bulk inserts:
+       stems and entities are resolved with one IN lookup each and all rows are 
+       written with insert_many.
+       Returns the stored resources, aligned with prepared_resources: the given ones,
+       or the rows another writer persisted in the meantime (then left as they are).'''
+    if not prepared_resources:
+        return []
+    resources = [resource for resource, entities, stems in prepared_resources]
+
+    stored = {}
+    with db.transaction():
+        # resources
+        for social_network in set(resource.social_network for resource in resources):
+            by_external_id = dict((str(resource.external_id), resource) 
+                for resource, entities, stems in prepared_resources 
+                if resource.social_network == social_network)
+            external_ids = by_external_id.keys()
+            inserted = set(external_ids[i] for i in _insert_new_rows(Resource, 
+                [dict((field.name, getattr(by_external_id[external_id], field.name)) for field in RESOURCE_FIELDS)
+                for external_id in external_ids]))
+            for uid, external_id in (Resource
+                .select(Resource.uid, Resource.external_id)
+                .where((Resource.social_network == social_network) & (Resource.external_id << external_ids))
+                .tuples()):
+                if external_id in inserted:
+                    by_external_id[external_id].uid = uid
                 else:
-                    entity_object = entity_query.get()
+                    stored[(social_network, external_id)] = uid
+        if stored:
+            for resource in Resource.select().where(Resource.uid << stored.values()):
+                stored[(resource.social_network, resource.external_id)] = resource
+            # links of the resources stored by another writer are already there
+            prepared_resources = [(resource, entities, stems) for resource, entities, stems in prepared_resources
+                if (resource.social_network, str(resource.external_id)) not in stored]
 
-                # map resource and entity
-                ResourceEntity(
-                    entity = entity_object,
-                    resource = resource,
-                    rho = entity['rho']
-                ).save()
+        # entities
+        entity_uids = _resolve_terms(Entity, Entity.entity, ENTITY_CACHE,
+            set(entity['entity'] for resource, entities, stems in prepared_resources for entity in entities))
+        links = {}
+        entity_freqs = {}
+        for resource, entities, stems in prepared_resources:
+            for entity in entities:
+                uid = entity_uids[entity['entity']]
+                link = links.setdefault((resource.uid, uid), {'entity': uid, 'resource': resource.uid, 
+                    'count': 0, 'rho_sum': 0.})
+                link['count'] = link['count'] + 1
+                link['rho_sum'] = link['rho_sum'] + entity['rho']
+                entity_freqs[uid] = entity_freqs.get(uid, 0) + 1
+        _insert_rows(ResourceEntity, links.values())
+        increment_doc_freq(Entity, entity_freqs)
 
-            # stems
-            stems = resourceutil.extract_stems(content)
+        # stems
+        stem_uids = _resolve_terms(Stem, Stem.stem, STEM_CACHE,
+            set(stem for resource, entities, stems in prepared_resources for stem in stems))
+        links = {}
+        stem_freqs = {}
+        for resource, entities, stems in prepared_resources:
             for stem in stems:
-                stem_query = Stem.select().where(Stem.stem == stem)
-                if not stem_query.exists():
-                    # stem does not exist yet
-                    stem_object = Stem(stem=stem)
-                    stem_object.save()
-                else:
-                    stem_object = stem_query.get()
+                uid = stem_uids[stem]
+                link = links.setdefault((resource.uid, uid), {'stem': uid, 'resource': resource.uid, 'tf': 0})
+                link['tf'] = link['tf'] + 1
+                stem_freqs[uid] = stem_freqs.get(uid, 0) + 1
+        _insert_rows(ResourceStem, links.values())
+        increment_doc_freq(Stem, stem_freqs)
+
+    # only cache the new uids once committed
+    for term, uid in entity_uids.iteritems():
+        ENTITY_CACHE.put(term, uid)
+    for term, uid in stem_uids.iteritems():
+        STEM_CACHE.put(term, uid)
+    notify_ingest()
+    return [stored.get((resource.social_network, str(resource.external_id)), resource) for resource in resources]
 
-                # map resource and stem
-                ResourceStem(
-                    stem = stem_object,
-                    resource = resource
-                ).save()
+def _resolve_terms(model, field, cache, terms):
+    '''Map each term (stem or entity title) to its uid, creating missing ones.'''
+    uids = {}
+    uncached = []
+    for term in terms:
+        uid = cache.get(term)
+        if uid is None:
+            uncached.append(term)
         else:
-            return None # resource not in English, return None
+            uids[term] = uid
+    for i in xrange(0, len(uncached), INSERT_BATCH_SIZE):
+        chunk = uncached[i:i + INSERT_BATCH_SIZE]
+        for uid, term in model.select(model.uid, field).where(field << chunk).tuples():
+            uids[term] = uid
+        missing = [term for term in chunk if term not in uids]
+        if missing:
+            _insert_rows(model, [{field.name: term} for term in missing], ignore=True)
+            for uid, term in model.select(model.uid, field).where(field << missing).tuples():
+                uids[term] = uid
+        # terms equal to a stored one for the database collation but not for python
+        for term in chunk:
+            if term not in uids:
+                uids[term] = model.select(model.uid).where(field == term).get().uid
+    return uids
 
-        return resource # return newly created resource
-    else:
-        return query.get() # return resource from the db
+def _insert_rows(model, rows, ignore=False):
+    '''Multi-row INSERTs, skipping rows violating a unique index if ignore.'''
+    for i in xrange(0, len(rows), INSERT_BATCH_SIZE):
+        query = model.insert_many(rows[i:i + INSERT_BATCH_SIZE])
+        if ignore:
+            insert_ignore(query)
+        else:
+            query.execute()
+
+def _insert_new_rows(model, rows):
+    '''Multi-row INSERTs of rows another writer may have stored in the meantime:
+       a batch violating a unique index is inserted again row by row, skipping 
+       the stored rows. Returns the indexes of the rows inserted.'''
+    inserted = []
+    for i in xrange(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[i:i + INSERT_BATCH_SIZE]
+        try:
+            with db.atomic():
+                model.insert_many(batch).execute()
+            inserted.extend(xrange(i, i + len(batch)))
+        except IntegrityError:
+            inserted.extend(i + j for j, row in enumerate(batch) if insert_ignore(model.insert(**row)))
+    return inserted
+
+def _row(instance):
+    '''Column values of a model instance, without its uid.'''
+    return dict((field.name, getattr(instance, field.name)) 
+        for field in instance._meta.sorted_fields if field.name != 'uid')
+
+def increment_doc_freq(model, freqs):
+    '''Add the new link counts {uid: count} to the doc_freq column of Stem or Entity.
+       Terms sharing the same count are updated with a single query.'''
+    uids_by_count = {}
+    for uid, count in freqs.iteritems():
+        uids_by_count.setdefault(count, []).append(uid)
+    for count, uids in uids_by_count.iteritems():
+        for i in xrange(0, len(uids), INSERT_BATCH_SIZE):
+            (model
+                .update(doc_freq=model.doc_freq + count)
+                .where(model.uid << uids[i:i + INSERT_BATCH_SIZE])
+                .execute())
+
+def rebuild_doc_freq():
+    '''Recompute doc_freq of every stem and entity from the link tables.
+       Add the doc_freq columns first if the tables predate them.'''
+    migrator = MySQLMigrator(db)
+    for model in (Stem, Entity):
+        columns = [column.name for column in db.get_columns(model._meta.db_table)]
+        if 'doc_freq' not in columns:
+            migrate(migrator.add_column(model._meta.db_table, 'doc_freq', model.doc_freq))
 
+    for model, link, key, column in ((Stem, ResourceStem, 'stem_id', 'tf'), 
+            (Entity, ResourceEntity, 'entity_id', 'count')):
+        if column in [c.name for c in db.get_columns(link._meta.db_table)]:
+            frequency = 'COALESCE(SUM(%s), 0)' % (db.quote_char + column + db.quote_char)
+        else:
+            # link table not aggregated yet (see _migrate_aggregate_links): one row per occurrence
+            frequency = 'COUNT(*)'
+        db.execute_sql(
+            'UPDATE %(table)s SET doc_freq = ('
+            'SELECT %(frequency)s FROM %(link)s WHERE %(link)s.%(key)s = %(table)s.uid)' % {
+                'table': model._meta.db_table,
+                'link': link._meta.db_table,
+                'key': key,
+                'frequency': frequency})
+
+def restem(batch_size=10000, processes=None):
+    '''Recompute the stems of every resource, e.g. after a change of the stemmer.
+       Stemming runs in a pool of processes, url contents come from the API cache
+       when possible. Stems left without resources are kept with a doc_freq of 0.'''
+    pool = multiprocessing.Pool(processes)
+    last_uid = 0
+    try:
+        while True:
+            resources = list(Resource
+                .select(Resource.uid, Resource.raw_content)
+                .where(Resource.uid > last_uid)
+                .order_by(Resource.uid)
+                .limit(batch_size))
+            if not resources:
+                break
+            last_uid = resources[-1].uid
+
+            contents = [resourceutil.extract_content_from_url(resource.raw_content) for resource in resources]
+            all_stems = list(resourceutil.extract_stems_batch(contents, pool=pool))
+            with db.transaction():
+                ResourceStem.delete().where(ResourceStem.resource << [resource.uid for resource in resources]).execute()
+                stem_uids = _resolve_terms(Stem, Stem.stem, STEM_CACHE, set(stem for stems in all_stems for stem in stems))
+                links = {}
+                for resource, stems in zip(resources, all_stems):
+                    for stem in stems:
+                        key = (resource.uid, stem_uids[stem])
+                        links[key] = links.get(key, 0) + 1
+                _insert_rows(ResourceStem, [{'resource': resource_uid, 'stem': stem_uid, 'tf': tf}
+                    for (resource_uid, stem_uid), tf in links.iteritems()])
+            for term, uid in stem_uids.iteritems():
+                STEM_CACHE.put(term, uid)
+    finally:
+        pool.terminate()
+        pool.join()
+    rebuild_doc_freq()
+    notify_ingest()
+
+def graph_version():
+    '''Changes whenever resources, links or completed users are added to the graph:
+       highest uid of each link table and number of completed users.'''
+    return (
+        ResourceStem.select(fn.MAX(ResourceStem.uid)).scalar(),
+        ResourceEntity.select(fn.MAX(ResourceEntity.uid)).scalar(),
+        ResourceUser.select(fn.MAX(ResourceUser.uid)).scalar(),
+        User.select().where(User.completed == True).count())
 
 def map_user_with_resource(user, resource, distance):
     ResourceUser(
@@ -165,6 +757,7 @@ def map_user_with_resource(user, resource, distance):
         resource = resource,
         distance = distance
     ).save()
+    notify_ingest()
 
 def print_statistics():
     query = User.select()
@@ -175,4 +768,21 @@ def print_statistics():
     else:
         print 'number of completed users: 0\n'
     print 'number of resources: ' + str(Resource.select().count()) + '\n'
-     
\ No newline at end of file
+    for name, cache in (('stem', STEM_CACHE), ('entity', ENTITY_CACHE), ('user', USER_CACHE)):
+        stats = cache.statistics()
+        print '%s cache: %d entries, %d hits, %d misses\n' % (name, stats['size'], stats['hits'], stats['misses'])
+     
+
+if __name__ == '__main__':
+    # usage: python graphmanager.py migrate|rebuild_doc_freq|restem
+    if sys.argv[1:] == ['migrate']:
+        db.connect()
+        migrate_graph()
+    elif sys.argv[1:] == ['rebuild_doc_freq']:
+        db.connect()
+        rebuild_doc_freq()
+    elif sys.argv[1:] == ['restem']:
+        db.connect()
+        restem()
+    else:
+        print 'usage: python graphmanager.py migrate|rebuild_doc_freq|restem'
@@ -1,8 +1,10 @@
-import re, time
+import re, sys
 import graphmanager as graph
 from instagram import client
+from instagram.bind import InstagramAPIError
 from crawler import Crawler
 from httplib2 import ServerNotFoundError
+from ratelimit import limiter, RateLimited
 
 # constant storing the social network type
 SN = 'IG'
@@ -13,10 +15,23 @@ CURSOR_REGEX = re.compile(r'cursor=([^&]+)')
 # Instagram API object
 api = client.InstagramAPI(client_id='') # add your own client_id
 
+def call_api(function):
+    '''Call the Instagram API through the shared rate limiter, retrying on network errors.'''
+    def request():
+        try:
+            return function()
+        except InstagramAPIError as e:
+            if e.status_code == 429:
+                raise RateLimited()
+            raise
+    result = limiter.call('instagram', request, retry_on=(ServerNotFoundError,))
+    limiter.update_remaining('instagram', getattr(api, 'x_ratelimit_remaining', None))
+    return result
+
 class InstagramCrawler(Crawler):
     '''InstagramCrawler implements abstract methods of Crawler.'''
-    def __init__(self, social_network):
-        super(InstagramCrawler, self).__init__(social_network)
+    def __init__(self, social_network, max_pages=None):
+        super(InstagramCrawler, self).__init__(social_network, max_pages)
 
     def get_first_user(self):
         '''Get the first user to init the graph.'''
@@ -25,14 +40,7 @@ class InstagramCrawler(Crawler):
         seed_user_id = 4355568
         # create first user and add him to the graph
         # get user info from Instagram
-        retry = True
-        while retry:
-            try:
-                time.sleep(0.7)
-                user_info = api.user(seed_user_id)
-            except ServerNotFoundError as e:
-                retry = True
-            retry = False
+        user_info = call_api(lambda: api.user(seed_user_id))
         # create first user
         user = graph.User(
             social_network=self.social_network, 
@@ -46,16 +54,10 @@ class InstagramCrawler(Crawler):
     def get_user_profile(self, user):
         '''Get user profile.'''
         # add user profile to the graph as a resource
-        retry = True
-        while retry:
-            try:
-                time.sleep(0.7)
-                user_info = api.user(user.external_id)
-                retry = False
-            except ServerNotFoundError as e:
-                retry = True
-            except:
-                return None
+        try:
+            user_info = call_api(lambda: api.user(user.external_id))
+        except:
+            return None
         if user_info.bio is not None:
             raw_content = user_info.bio
             if user_info.website:
@@ -77,30 +79,25 @@ class InstagramCrawler(Crawler):
 
     def get_user_resources(self, user):
         '''Get resources from the user.'''
-        resources = []
+        return [resource for page in self.iter_user_resources(user) for resource in page]
+
+    def iter_user_resources(self, user):
+        '''Yield the resources of the user, one list per page of recent media.'''
         max_id = ''
-        while True:
-            followees_page = []
-            next = ''
-            retry = True
-            error = False
-            while retry:
-                try:
-                    time.sleep(0.7) # be nice with the API
-                    if max_id == '':
-                        recent_media, next = api.user_recent_media(user_id=user.external_id, count=33)
-                    else:
-                        recent_media, next = api.user_recent_media(user_id=user.external_id, max_id=max_id, count=33)
-                    retry = False
-                except ServerNotFoundError as e:
-                    retry = True
-                except:
-                    error = True
-                    break;
-
-            if error:
-                break;
+        pages = 0
+        while self.max_pages is None or pages < self.max_pages:
+            try:
+                if max_id == '':
+                    recent_media, next = call_api(
+                        lambda: api.user_recent_media(user_id=user.external_id, count=33))
+                else:
+                    recent_media, next = call_api(
+                        lambda: api.user_recent_media(user_id=user.external_id, max_id=max_id, count=33))
+            except:
+                break
 
+            pages = pages + 1
+            resources = []
             for media in recent_media:
                 create_resource = False
                 if hasattr(media, 'caption') and media.caption is not None:
@@ -135,6 +132,7 @@ class InstagramCrawler(Crawler):
                         )
                     if resource is not None:
                         resources.append(resource)
+            yield resources
 
             if next is None:
                 break
@@ -145,34 +143,28 @@ class InstagramCrawler(Crawler):
                     max_id = max_id_matcher.group(1)
                 else:
                     break
-        return resources
 
     def get_user_followees(self, user):
         '''Get all people that this user follows.'''
-        followees = []
+        return [followee for page in self.iter_user_followees(user) for followee in page]
+
+    def iter_user_followees(self, user):
+        '''Yield the people that this user follows, one list per page.'''
         cursor = ''
-        while True:
-            followees_page = []
-            next = ''
-            retry = True
-            error = False
-            while retry:
-                try:
-                    time.sleep(0.7) # be nice with the API
-                    if cursor == '':
-                        followees_page, next = api.user_follows(user_id=user.external_id)
-                    else:
-                        followees_page, next = api.user_follows(user_id=user.external_id, cursor=cursor)
-                    retry = False
-                except ServerNotFoundError as e:
-                    retry = True
-                except:
-                    error = True
-                    break;
-
-            if error:
-                break;
+        pages = 0
+        while self.max_pages is None or pages < self.max_pages:
+            try:
+                if cursor == '':
+                    followees_page, next = call_api(
+                        lambda: api.user_follows(user_id=user.external_id))
+                else:
+                    followees_page, next = call_api(
+                        lambda: api.user_follows(user_id=user.external_id, cursor=cursor))
+            except:
+                break
 
+            pages = pages + 1
+            followees = []
             for user_info in followees_page:
                 followee = graph.User(
                     social_network=SN, 
@@ -182,6 +174,7 @@ class InstagramCrawler(Crawler):
                     completed=False
                 )
                 followees.append(followee)
+            yield followees
 
             if next is None:
                 break
@@ -192,7 +185,15 @@ class InstagramCrawler(Crawler):
                     cursor = cursor_matcher.group(1)
                 else:
                     break
-        return followees
 
 # let's crawl Instagram!
-InstagramCrawler(SN).run()
+# usage: python instagram_crawler.py [number of workers] [maximum number of pages per user]
+#        python instagram_crawler.py refresh [maximum number of users]
+if sys.argv[1:2] == ['refresh']:
+    InstagramCrawler(SN).refresh(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+else:
+    max_pages = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    if len(sys.argv) > 1:
+        InstagramCrawler(SN, max_pages).run_concurrent(int(sys.argv[1]))
+    else:
+        InstagramCrawler(SN).run()
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    '''Bounded, thread-safe mapping evicting the least recently used keys.
+       Keeps hit and miss counters.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses = self.misses + 1
+                return default
+            # move key to the most recently used end
+            self._data[key] = value
+            self.hits = self.hits + 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def statistics(self):
+        '''Returns a dict with the size and the hit/miss counters of the cache.'''
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total > 0 else 0.
+        }
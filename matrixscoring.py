@@ -0,0 +1,230 @@
+import numpy as np
+import scipy.sparse as sp
+import graphmanager as graph
+from scoring import ALPHA, MAX_RESOURCES_PER_USER, distance_weight
+
+class MatrixScorer(object):
+    '''Vectorized scoring based on sparse matrices built once from the graph:
+       resource x stem (term frequencies), resource x entity (rho weighted
+       frequencies) and user x resource (distance weights).'''
+
+    def __init__(self):
+        self.resource_uids = np.zeros(0, dtype=np.int64)
+        self.user_uids = np.zeros(0, dtype=np.int64)
+        self.stem_columns = {}
+        self.entity_columns = {}
+        self.version = None
+
+    def build(self, completed_only=True):
+        '''Load the graph tables into sparse matrices. Link rows of resources
+           ingested after resource_uids was read are left out.'''
+        self.version = graph.graph_version()
+        self.stem_columns = {}
+        self.entity_columns = {}
+        self.resource_uids = np.fromiter(
+            (uid for (uid,) in graph.Resource.select(graph.Resource.uid).tuples().iterator()),
+            dtype=np.int64)
+        self.resource_uids.sort()
+
+        # resource x stem
+        rows, cols, tfs = [], [], []
+        query = (graph.ResourceStem
+            .select(graph.ResourceStem.resource, graph.Stem.stem, graph.ResourceStem.tf)
+            .join(graph.Stem)
+            .tuples()
+            .iterator())
+        for resource_uid, stem, tf in query:
+            rows.append(resource_uid)
+            cols.append(self.stem_columns.setdefault(stem, len(self.stem_columns)))
+            tfs.append(tf)
+        self.stems = self._matrix(rows, cols, np.asarray(tfs, dtype=np.float64), len(self.stem_columns))
+        # inverse resource frequency squared of each stem
+        self.stem_weights = _squared_inverse(np.asarray(self.stems.sum(axis=0)).ravel())
+
+        # resource x entity
+        rows, cols, counts, rho_sums = [], [], [], []
+        query = (graph.ResourceEntity
+            .select(graph.ResourceEntity.resource, graph.Entity.entity, 
+                graph.ResourceEntity.count, graph.ResourceEntity.rho_sum)
+            .join(graph.Entity)
+            .tuples()
+            .iterator())
+        for resource_uid, entity, count, rho_sum in query:
+            rows.append(resource_uid)
+            cols.append(self.entity_columns.setdefault(entity, len(self.entity_columns)))
+            counts.append(count)
+            rho_sums.append(rho_sum)
+        counts = np.asarray(counts, dtype=np.float64)
+        rho_sums = np.asarray(rho_sums, dtype=np.float64)
+        # weight * ef, where weight is the average rho plus one when positive
+        self.entities = self._matrix(rows, cols,
+            np.where(rho_sums > 0, rho_sums + counts, rho_sums), len(self.entity_columns))
+        known = self._resource_rows(rows)[1]
+        frequencies = np.bincount(np.asarray(cols, dtype=np.int64)[known], weights=counts[known],
+            minlength=len(self.entity_columns))
+        self.entity_weights = _squared_inverse(frequencies)
+
+        # user x resource
+        users = graph.User.select(graph.User.uid)
+        if completed_only:
+            users = users.where(graph.User.completed == True)
+        self.user_uids = np.fromiter(
+            (uid for (uid,) in users.tuples().iterator()), dtype=np.int64)
+        self.user_uids.sort()
+        user_rows, resource_cols, weights = [], [], []
+        query = (graph.ResourceUser
+            .select(graph.ResourceUser.user, graph.ResourceUser.resource, graph.ResourceUser.distance)
+            .tuples()
+            .iterator())
+        for user_uid, resource_uid, distance in query:
+            user_rows.append(user_uid)
+            resource_cols.append(resource_uid)
+            weights.append(distance_weight(distance))
+        self.users = self._user_matrix(user_rows, resource_cols, weights)
+        return self
+
+    def _resource_rows(self, resource_uids):
+        '''Rows of resource uids and mask of the uids that have one.'''
+        resource_uids = np.asarray(resource_uids, dtype=np.int64)
+        rows = np.searchsorted(self.resource_uids, resource_uids)
+        known = rows < len(self.resource_uids)
+        known[known] = self.resource_uids[rows[known]] == resource_uids[known]
+        return rows, known
+
+    def _matrix(self, resource_uids, cols, values, n_cols):
+        rows, known = self._resource_rows(resource_uids)
+        return sp.csr_matrix((np.asarray(values)[known], (rows[known], np.asarray(cols, dtype=np.int64)[known])),
+            shape=(len(self.resource_uids), n_cols))
+
+    def _user_matrix(self, user_uids, resource_uids, weights):
+        user_uids = np.asarray(user_uids, dtype=np.int64)
+        resource_uids = np.asarray(resource_uids, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        # only keep users that are scored and resources that have a row
+        rows = np.searchsorted(self.user_uids, user_uids)
+        keep = rows < len(self.user_uids)
+        keep[keep] = self.user_uids[rows[keep]] == user_uids[keep]
+        cols, known = self._resource_rows(resource_uids)
+        keep &= known
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+        shape = (len(self.user_uids), len(self.resource_uids))
+        if len(rows) == 0:
+            return sp.csr_matrix(shape)
+        # a resource mapped several times with a user keeps its closest distance
+        order = np.lexsort((cols, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        starts = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])])
+        weights = np.maximum.reduceat(weights, starts)
+        return sp.csr_matrix((weights, (rows[starts], cols[starts])), shape=shape)
+
+    def score_resources(self, query_stems, query_entities):
+        '''Score all resources with two sparse matrix-vector products.
+           Returns an array of scores aligned with resource_uids.'''
+        stem_vector = np.zeros(len(self.stem_columns))
+        for stem in query_stems:
+            col = self.stem_columns.get(stem)
+            if col is not None:
+                stem_vector[col] += self.stem_weights[col]
+        entity_vector = np.zeros(len(self.entity_columns))
+        for entity in query_entities:
+            col = self.entity_columns.get(entity['entity'])
+            if col is not None:
+                entity_vector[col] += self.entity_weights[col]
+        return ALPHA * self.stems.dot(stem_vector) + (1-ALPHA) * self.entities.dot(entity_vector)
+
+    def score_users(self, resource_scores):
+        '''Score users from their MAX_RESOURCES_PER_USER best resources.
+           Returns an array of scores aligned with user_uids.'''
+        matrix = self.users
+        row_ids = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        values = resource_scores[matrix.indices]
+        contributions = values * matrix.data
+
+        # users with few resources: every resource counts
+        long_rows = np.diff(matrix.indptr)[row_ids] > MAX_RESOURCES_PER_USER
+        scores = np.zeros(matrix.shape[0])
+        scores += np.bincount(row_ids[~long_rows], weights=contributions[~long_rows],
+            minlength=matrix.shape[0])
+
+        # other users: keep the best resources only
+        if long_rows.any():
+            row_ids, values, contributions = row_ids[long_rows], values[long_rows], contributions[long_rows]
+            order = np.lexsort((-values, row_ids))
+            row_ids, contributions = row_ids[order], contributions[order]
+            starts = np.flatnonzero(np.r_[True, row_ids[1:] != row_ids[:-1]])
+            ranks = np.arange(len(row_ids)) - np.repeat(starts, np.diff(np.r_[starts, len(row_ids)]))
+            best = ranks < MAX_RESOURCES_PER_USER
+            scores += np.bincount(row_ids[best], weights=contributions[best],
+                minlength=matrix.shape[0])
+        return scores
+
+class ResourceScores(dict):
+    '''{resource uid: score} of the resources with a score, keeping the array of
+       MatrixScorer.score_resources for the vectorized user scoring.'''
+
+    def __init__(self, resource_uids, scores):
+        nonzero = np.flatnonzero(scores)
+        dict.__init__(self, zip(resource_uids[nonzero].tolist(), scores[nonzero].tolist()))
+        self.array = scores
+
+class MatrixIndex(object):
+    '''A MatrixScorer behind the interfaces of scoring.InvertedIndex and
+       scoring.UserIndex: answerquery.answer can use it as both indexes.'''
+
+    def __init__(self, scorer=None):
+        self.scorer = scorer or MatrixScorer()
+
+    @property
+    def version(self):
+        return self.scorer.version
+
+    def build(self, completed_only=True):
+        self.scorer.build(completed_only)
+        return self
+
+    def score_resources(self, query_stems, query_entities):
+        '''Returns a ResourceScores.'''
+        return ResourceScores(self.scorer.resource_uids, self.scorer.score_resources(query_stems, query_entities))
+
+    def score_users(self, resource_scores):
+        '''Returns a dict {user uid: score} for users with a score.'''
+        scores = self.scorer.score_users(self._array(resource_scores))
+        nonzero = np.flatnonzero(scores)
+        return dict(zip(self.scorer.user_uids[nonzero].tolist(), scores[nonzero].tolist()))
+
+    def top_users(self, resource_scores, k=10):
+        '''Returns [(user uid, score), ...] best first.'''
+        scores = self.scorer.score_users(self._array(resource_scores))
+        rows = np.flatnonzero(scores > 0)
+        if len(rows) > k:
+            rows = rows[np.argpartition(-scores[rows], k)[:k]]
+        rows = rows[np.argsort(-scores[rows], kind='mergesort')]
+        return zip(self.scorer.user_uids[rows].tolist(), scores[rows].tolist())
+
+    def best_resources(self, user_uid, resource_scores):
+        '''Resources of a user, best scored first.'''
+        user_uids = self.scorer.user_uids
+        row = np.searchsorted(user_uids, user_uid)
+        if row == len(user_uids) or user_uids[row] != user_uid:
+            return []
+        matrix = self.scorer.users
+        cols = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+        cols = cols[np.argsort(-self._array(resource_scores)[cols], kind='mergesort')]
+        return self.scorer.resource_uids[cols].tolist()
+
+    def _array(self, resource_scores):
+        '''Scores aligned with resource_uids.'''
+        if isinstance(resource_scores, ResourceScores):
+            return resource_scores.array
+        scores = np.zeros(len(self.scorer.resource_uids))
+        if resource_scores:
+            rows, known = self.scorer._resource_rows(resource_scores.keys())
+            scores[rows[known]] = np.asarray(resource_scores.values(), dtype=np.float64)[known]
+        return scores
+
+def _squared_inverse(frequencies):
+    '''irf^2 of each term, 1 for terms with no occurrence.'''
+    weights = np.ones(len(frequencies))
+    present = frequencies > 0
+    weights[present] = 1. / frequencies[present] ** 2
+    return weights
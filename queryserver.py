@@ -0,0 +1,189 @@
+import sys, json, time, urlparse, threading
+from collections import deque
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import graphmanager as graph
+import answerquery
+from scoring import InvertedIndex, UserIndex
+
+DEFAULT_PORT = 8000
+# seconds between two checks of the graph version
+RELOAD_INTERVAL = 60
+# number of recent queries kept for the latency percentiles
+LATENCY_WINDOW = 1000
+
+def close_connection():
+    '''Give the connection of the current thread back to the pool, if it has one.'''
+    if not graph.db.is_closed():
+        graph.db.close()
+
+class LatencyStats(object):
+    '''Count and mean of the query latencies, percentiles of the recent ones.'''
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.count = 0
+        self.total = 0.
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.count = self.count + 1
+            self.total = self.total + latency
+            self.recent.append(latency)
+
+    def statistics(self):
+        '''Returns a dict of latencies in milliseconds.'''
+        with self._lock:
+            recent = sorted(self.recent)
+            stats = {
+                'queries': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.
+            }
+        for name, percentile in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            stats[name] = recent[min(len(recent) - 1, int(len(recent) * percentile))] * 1000 if recent else 0.
+        return stats
+
+class QueryEngine(object):
+    '''Scoring indexes kept warm between queries, loaded from the graph or from
+       a snapshot directory (see snapshot.py). A background thread reloads them
+       when the version of their source changes, queries keep using the previous
+       indexes until the new ones are ready. With matrix, the graph is loaded into
+       a matrixscoring.MatrixIndex instead.'''
+
+    def __init__(self, snapshot_directory=None, reload_interval=RELOAD_INTERVAL, matrix=False):
+        if matrix and snapshot_directory is not None:
+            raise ValueError('matrix scoring loads the graph, not a snapshot')
+        self.snapshot_directory = snapshot_directory
+        self.reload_interval = reload_interval
+        self.matrix = matrix
+        self.latency = LatencyStats()
+        self.version = None
+        self.index = None
+        self.user_index = None
+        self.loaded = None
+        self.cache = answerquery.QueryCache()
+        self._lock = threading.Lock()
+
+    def source_version(self):
+        if self.snapshot_directory is not None:
+            import snapshot
+            return snapshot.read_version(self.snapshot_directory)
+        return graph.graph_version()
+
+    def load(self):
+        '''Build the indexes of the current version of the source and swap them in.'''
+        if self.snapshot_directory is not None:
+            import snapshot
+            index = snapshot.Snapshot(self.snapshot_directory)
+            version = index.version
+            user_index = index.user_index()
+        else:
+            # read before the indexes: a change during the load triggers another one
+            version = graph.graph_version()
+            if self.matrix:
+                import matrixscoring
+                index = user_index = matrixscoring.MatrixIndex().build()
+            else:
+                index = InvertedIndex().build()
+                user_index = UserIndex().build()
+        with self._lock:
+            self.index, self.user_index, self.version = index, user_index, version
+            self.loaded = time.time()
+        # answers of the previous version can not be hit anymore
+        self.cache.clear()
+
+    def reload_loop(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                if self.source_version() != self.version:
+                    self.load()
+            except Exception as e:
+                print 'reload failed: ' + str(e)
+            finally:
+                close_connection()
+
+    def start_reloading(self):
+        thread = threading.Thread(target=self.reload_loop)
+        thread.daemon = True
+        thread.start()
+
+    def answer(self, query, limit=10):
+        '''Returns the best users and their best located resources as a JSON-able dict.'''
+        start = time.time()
+        with self._lock:
+            index, user_index, version = self.index, self.user_index, self.version
+        experts, resources = answerquery.answer(query, index, user_index, limit, 
+            cache=self.cache, version=version)
+        latency = time.time() - start
+        self.latency.record(latency)
+        return {
+            'query': query,
+            'experts': [{'username': user.username, 'url': user.url, 'score': score} for user, score in experts],
+            'resources': [{'url': resource.url, 'location_name': resource.location_name} for resource in resources],
+            'latency_ms': latency * 1000
+        }
+
+    def statistics(self):
+        stats = self.latency.statistics()
+        stats['version'] = self.version
+        stats['loaded'] = self.loaded
+        stats['cache'] = self.cache.statistics()
+        return stats
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''GET /query?q=<text>[&limit=<n>] answers a query, GET /stats returns the latencies.'''
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        try:
+            if url.path == '/query' and params.get('q'):
+                limit = int(params.get('limit', ['10'])[0])
+                self.send_json(200, self.server.engine.answer(params['q'][0].decode('utf-8'), limit))
+            elif url.path == '/stats':
+                self.send_json(200, self.server.engine.statistics())
+            else:
+                self.send_json(404, {'error': 'usage: /query?q=<text>[&limit=<n>] or /stats'})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+        finally:
+            close_connection()
+
+    def send_json(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    '''HTTP server answering each query in its own thread with a shared QueryEngine.'''
+    daemon_threads = True
+
+    def __init__(self, address, engine):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.engine = engine
+
+def serve(port=DEFAULT_PORT, snapshot_directory=None, matrix=False):
+    engine = QueryEngine(snapshot_directory, matrix=matrix)
+    engine.load()
+    engine.start_reloading()
+    server = QueryServer(('', port), engine)
+    print 'serving queries on port %d, graph version %s' % (port, engine.version)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    # usage: python queryserver.py [--matrix] [port] [snapshot directory]
+    graph.init_graph()
+    matrix = '--matrix' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--matrix']
+    serve(int(args[0]) if len(args) > 0 else DEFAULT_PORT,
+        args[1] if len(args) > 1 else None, matrix)
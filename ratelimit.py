@@ -0,0 +1,129 @@
+import random, threading, time
+
+# default number of retries of a call before giving up
+MAX_RETRIES = 10
+# exponential backoff: first delay and maximum delay in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.
+# pause when an API reports an exhausted quota without telling when to retry
+QUOTA_PAUSE = 60.
+
+class RateLimited(Exception):
+    '''Raised by an API call rejected because of rate limiting.
+       retry_after is the number of seconds to wait, if known.'''
+    def __init__(self, retry_after=None):
+        super(RateLimited, self).__init__('rate limited, retry after ' + str(retry_after))
+        self.retry_after = retry_after
+
+class TokenBucket(object):
+    '''Allow rate calls per second on average, with bursts of capacity calls.'''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        # no token is given before this time
+        self.paused_until = 0.
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait for a token. Returns the number of seconds waited.'''
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # take the token now, even if it is only available later
+            self.tokens = self.tokens - 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0.)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        '''Do not give any token for the given number of seconds.'''
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+class RateLimiter(object):
+    '''Token bucket per endpoint plus retries with exponential backoff and jitter.
+       Keeps statistics of the time spent throttled for each endpoint.'''
+
+    def __init__(self):
+        self.buckets = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def configure(self, endpoint, rate, capacity=1):
+        '''Allow rate calls per second to the endpoint, with bursts of capacity calls.'''
+        with self._lock:
+            self.buckets[endpoint] = TokenBucket(rate, capacity)
+            self.stats.setdefault(endpoint, {'calls': 0, 'retries': 0, 'throttled_time': 0.})
+
+    def call(self, endpoint, function, retry_on=(), max_retries=MAX_RETRIES):
+        '''Call function() once a token of the endpoint is available.
+           Retry with exponential backoff on the exceptions of retry_on and on RateLimited,
+           the last exception is raised after max_retries retries.'''
+        if endpoint not in self.buckets:
+            raise KeyError('endpoint not configured: ' + endpoint)
+        attempt = 0
+        while True:
+            self._record(endpoint, 'throttled_time', self.buckets[endpoint].acquire())
+            self._record(endpoint, 'calls', 1)
+            try:
+                return function()
+            except RateLimited as e:
+                if attempt >= max_retries:
+                    raise
+                self.buckets[endpoint].pause(e.retry_after if e.retry_after is not None else QUOTA_PAUSE)
+            except retry_on:
+                if attempt >= max_retries:
+                    raise
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                self._record(endpoint, 'throttled_time', delay)
+                time.sleep(delay)
+            attempt = attempt + 1
+            self._record(endpoint, 'retries', 1)
+
+    def update_from_headers(self, endpoint, headers):
+        '''Honor the rate limit headers of an HTTP response (Retry-After, X-Ratelimit-Remaining).'''
+        headers = dict((key.lower(), value) for key, value in (headers or {}).items())
+        retry_after = parse_number(headers.get('retry-after'))
+        if retry_after is not None:
+            self.buckets[endpoint].pause(retry_after)
+        else:
+            self.update_remaining(endpoint, headers.get('x-ratelimit-remaining'))
+
+    def update_remaining(self, endpoint, remaining):
+        '''Pause the endpoint when the API reports that no call is remaining.'''
+        remaining = parse_number(remaining)
+        if remaining is not None and remaining <= 0:
+            self.buckets[endpoint].pause(QUOTA_PAUSE)
+
+    def _record(self, endpoint, key, value):
+        with self._lock:
+            self.stats[endpoint][key] = self.stats[endpoint][key] + value
+
+    def statistics(self):
+        '''Returns {endpoint: {'calls': ..., 'retries': ..., 'throttled_time': ...}}'''
+        with self._lock:
+            return dict((endpoint, dict(stats)) for endpoint, stats in self.stats.iteritems())
+
+def parse_number(value):
+    '''Parse a numeric header value, None if missing or invalid.'''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# rate limiter shared by all the API clients
+limiter = RateLimiter()
+# Instagram allows 5000 calls per hour
+limiter.configure('instagram', rate=5000 / 3600., capacity=5)
+limiter.configure('tagme', rate=2, capacity=2)
+limiter.configure('alchemyapi', rate=2, capacity=2)
+
+def print_statistics():
+    for endpoint, stats in sorted(limiter.statistics().iteritems()):
+        print '%s API: %d calls, %d retries, %d seconds throttled\n' % (
+            endpoint, stats['calls'], stats['retries'], stats['throttled_time'])
@@ -0,0 +1,88 @@
+import datetime
+import graphmanager as graph
+
+# bounds of the time between two refreshes of a user, in seconds
+MIN_REFRESH_INTERVAL = 24 * 3600
+MAX_REFRESH_INTERVAL = 60 * 24 * 3600
+# time before the first refresh of a user
+DEFAULT_REFRESH_INTERVAL = 7 * 24 * 3600
+# a user is refreshed when about this number of new resources is expected
+NEW_RESOURCES_PER_REFRESH = 10
+
+class RefreshSchedule(object):
+    '''Incremental re-crawl schedule of a social network, stored in the UserRefresh table.
+       Each crawled user has a high-water mark (newest resource, last crawl time) and is 
+       refreshed again after an interval adapted to the number of resources it publishes.'''
+
+    def __init__(self, social_network):
+        self.social_network = social_network
+
+    def seed(self):
+        '''Schedule a refresh of the completed users crawled before the schedule existed.
+           Does nothing if the schedule is not empty.'''
+        if self._query().exists():
+            return
+        now = datetime.datetime.now()
+        rows = [{
+            'user': uid,
+            'social_network': self.social_network,
+            'next_refresh': now
+        } for (uid,) in (graph.User
+            .select(graph.User.uid)
+            .where((graph.User.social_network == self.social_network) & (graph.User.completed == True))
+            .tuples())]
+        for i in xrange(0, len(rows), graph.INSERT_BATCH_SIZE):
+            graph.UserRefresh.insert_many(rows[i:i + graph.INSERT_BATCH_SIZE]).execute()
+
+    def due(self, limit=None):
+        '''UserRefresh rows of the users to refresh now, most overdue first, 
+           with their user loaded.'''
+        query = (graph.UserRefresh
+            .select(graph.UserRefresh, graph.User)
+            .join(graph.User)
+            .where(
+                (graph.UserRefresh.social_network == self.social_network)
+                & (graph.UserRefresh.next_refresh <= datetime.datetime.now()))
+            .order_by(graph.UserRefresh.next_refresh))
+        if limit is not None:
+            query = query.limit(limit)
+        return list(query)
+
+    def mark(self, user):
+        '''UserRefresh row of a user, None if it was never crawled.'''
+        return self._query().where(graph.UserRefresh.user == user.uid).first()
+
+    def update(self, user, newest_resource, new_resources):
+        '''Record a crawl of user that found new_resources resources, newest_resource
+           being the external id of the newest one (None if there is none), and 
+           schedule its next refresh.'''
+        now = datetime.datetime.now()
+        mark = self.mark(user)
+        if mark is None or mark.last_crawled is None:
+            interval = DEFAULT_REFRESH_INTERVAL
+        elif new_resources > 0:
+            # time to publish NEW_RESOURCES_PER_REFRESH resources at the observed rate
+            elapsed = (now - mark.last_crawled).total_seconds()
+            interval = elapsed * NEW_RESOURCES_PER_REFRESH / new_resources
+        else:
+            # inactive user: back off
+            interval = 2 * (mark.next_refresh - mark.last_crawled).total_seconds()
+        interval = min(max(interval, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL)
+        next_refresh = now + datetime.timedelta(seconds=interval)
+
+        if mark is None:
+            graph.UserRefresh.create(user=user.uid, social_network=self.social_network,
+                newest_resource=newest_resource, last_crawled=now, next_refresh=next_refresh)
+        else:
+            if newest_resource is not None:
+                mark.newest_resource = newest_resource
+            mark.last_crawled = now
+            mark.next_refresh = next_refresh
+            mark.save()
+
+    def _query(self):
+        return graph.UserRefresh.select().where(graph.UserRefresh.social_network == self.social_network)
+
+    def size(self):
+        '''Number of users due for a refresh.'''
+        return self._query().where(graph.UserRefresh.next_refresh <= datetime.datetime.now()).count()
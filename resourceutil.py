@@ -1,13 +1,13 @@
-import re, string, time, traceback, requests
-import nltk
-from alchemyapi import AlchemyAPI
+import os, re, string, traceback, urlparse, multiprocessing, threading
+import ratelimit
+from ratelimit import limiter, RateLimited
+from responsecache import ResponseCache
+from lrucache import LRUCache
 
 # API KEYS
 TAGME_API_KEY = '' # add you TAGME API key
+TAGME_URL = 'http://tagme.di.unipi.it/tag'
 
-MULTIPLE_SPACES_REGEX = re.compile('\s\s+')
-OTHER_THAN_SPACE_REGEX = re.compile('(\n|\t|\r)')
-HASHTAG_REGEX = re.compile(ur'#|\uff03')
 USERNAME_REGEX = re.compile(ur'\B[@\uff20][a-z0-9_]{1,20}')
 EMAIL_REGEX = re.compile(r'\b[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,4}\b')
 
@@ -20,67 +20,148 @@ PATH_CHARS = ur'(?:[\.,]?[%s!\*\'\(\);:=\+\$/%s#\[\]\-_,~@])' % (UTF_CHARS, '%')
 QUERY_CHARS = ur'[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~]'
 PATH_ENDING_CHARS = r'[%s\)=#/]' % UTF_CHARS
 QUERY_ENDING_CHARS = '[a-z0-9_&=#]'
-URL_REGEX = re.compile('((%s)((https?://|www\\.)(%s)(\/(%s*%s)?)?(\?%s*%s)?))'
-                       % (PRE_CHARS, DOMAIN_CHARS, PATH_CHARS,
-                          PATH_ENDING_CHARS, QUERY_CHARS, QUERY_ENDING_CHARS),
-                       re.IGNORECASE)
-
-# stopwords
-ENGLISH_STOPWORDS = set(nltk.corpus.stopwords.words('english'))
-NON_ENGLISH_STOPWORDS = set(nltk.corpus.stopwords.words()) - ENGLISH_STOPWORDS
-
-# stemmer
-stemmer = nltk.stem.porter.PorterStemmer()
-
-try:
-    # emoji regex (UCS-4 format)
-    EMOJI_REGEX = re.compile(u'[\U00010000-\U0010ffff]')
-except re.error:
-    # emoji regex (UCS-2 format)
-    EMOJI_REGEX = re.compile(u'[\uD800-\uDBFF][\uDC00-\uDFFF]')
-# miscellaneous symbols regex
-MISC_SYMBOLS_REGEX = re.compile(u'[\u20A0-\u27BF]')
-
-# Alchemy API
-alchemyapi = AlchemyAPI()
+URL_PATTERN = ('((%s)((https?://|www\\.)(%s)(\/(%s*%s)?)?(\?%s*%s)?))'
+               % (PRE_CHARS, DOMAIN_CHARS, PATH_CHARS,
+                  PATH_ENDING_CHARS, QUERY_CHARS, QUERY_ENDING_CHARS))
+
+# words of a text, as tokenized by nltk.wordpunct_tokenize without the punctuation
+WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+# number of characters of a text looked at by is_english: enough for a caption,
+# long texts (content extracted from links) are decided on their beginning
+LANGUAGE_WINDOW = 2000
+
+# memo of the stems of the most frequent tokens: token -> stem
+STEM_MEMO_SIZE = 200000
+stem_memo = LRUCache(STEM_MEMO_SIZE)
+
+# number of texts sent at once to a worker by the batch functions
+BATCH_CHUNK_SIZE = 500
+
+# characters replaced with a space by sanitize_content, as (first, last) code points:
+# hashtags, miscellaneous symbols, tabs and new lines, emoji characters are added below
+SPACED_CHARACTERS = [(ord('#'), ord('#')), (0xff03, 0xff03), (0x20A0, 0x27BF), 
+    (ord('\t'), ord('\n')), (ord('\r'), ord('\r'))]
+WHITESPACE_CHARACTERS = [(ord('\t'), ord('\r')), (ord(' '), ord(' '))]
+# usernames and email addresses, removed by sanitize_content in a single pass
+USERNAME_OR_EMAIL_REGEX = re.compile(u'%s|%s' % (USERNAME_REGEX.pattern, EMAIL_REGEX.pattern))
+
+def bmp_complement(ranges):
+    '''Character class of the characters of the basic multilingual plane outside of 
+       ranges [(first, last), ...]. Negated, it matches the characters of ranges and 
+       every character outside of the BMP (emoji characters), and it compiles much 
+       faster than a [\U00010000-\U0010ffff] class.'''
+    classes = []
+    start = 0
+    for first, last in sorted(ranges):
+        if first > start:
+            classes.append(u'%s-%s' % (re.escape(unichr(start)), re.escape(unichr(first - 1))))
+        start = max(start, last + 1)
+    classes.append(u'%s-\uffff' % re.escape(unichr(start)))
+    return u''.join(classes)
+
+# a run of spaces and spaced characters, or a single spaced character (in UCS-2 
+# format, the two halves of an emoji character are a run)
+SPACES_REGEX = re.compile(u'[^%s]{2,}|[^%s]' % (
+    bmp_complement(SPACED_CHARACTERS + WHITESPACE_CHARACTERS), bmp_complement(SPACED_CHARACTERS)))
+
+# on-disk cache of the TAGME and AlchemyAPI responses
+API_CACHE_DIRECTORY = os.environ.get('EXPERTFINDING_API_CACHE', 
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apicache'))
+api_cache = ResponseCache(API_CACHE_DIRECTORY)
+
+def lazy(function):
+    '''Decorator of the functions building the heavy globals of this module (nltk
+       corpora, stemmer, API client...): the value is built on the first call only,
+       so that importing the module stays cheap.'''
+    values = []
+    lock = threading.Lock()
+    def get():
+        if not values:
+            with lock:
+                if not values:
+                    values.append(function())
+        return values[0]
+    get.__name__ = function.__name__
+    get.__doc__ = function.__doc__
+    return get
+
+@lazy
+def url_regex():
+    return re.compile(URL_PATTERN, re.IGNORECASE)
+
+@lazy
+def english_stopwords():
+    import nltk
+    return set(nltk.corpus.stopwords.words('english'))
+
+@lazy
+def non_english_stopwords():
+    import nltk
+    return set(nltk.corpus.stopwords.words()) - english_stopwords()
+
+@lazy
+def stemmer():
+    from nltk.stem.porter import PorterStemmer
+    return PorterStemmer()
+
+@lazy
+def http_session():
+    '''HTTP session shared by the TAGME calls, keeps connections alive.'''
+    import requests
+    return requests.Session()
+
+@lazy
+def alchemyapi():
+    '''Alchemy API client.'''
+    from alchemyapi import AlchemyAPI
+    return AlchemyAPI()
+
+def configure_http_pool(size):
+    '''Keep up to size connections open to the TAGME API, for concurrent calls.'''
+    import requests
+    http_session().mount('http://', requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size))
+    http_session().mount('https://', requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size))
 
 def sanitize_content(content):
     '''Sanitize content: remove hashtag character, remove usernames,
-       remove email addresses, remove emoji characters, lowercase.'''
-    sane_content = content
-    # remove hashtag characters
-    sane_content = HASHTAG_REGEX.sub(' ', sane_content)
-    # remove usernames
-    sane_content = USERNAME_REGEX.sub('', sane_content)
-    # remove email addresses
-    sane_content = EMAIL_REGEX.sub('', sane_content)
-    # remove emoji characters and various similar symbols
-    sane_content = EMOJI_REGEX.sub(' ', sane_content)
-    sane_content = MISC_SYMBOLS_REGEX.sub(' ', sane_content)
-    # trim spaces and remove multiple spaces
-    sane_content = sane_content.strip()
-    sane_content = OTHER_THAN_SPACE_REGEX.sub(' ', sane_content)
-    sane_content = MULTIPLE_SPACES_REGEX.sub(' ', sane_content)
-    # lowercase
-    sane_content = sane_content.lower()
-    return sane_content
+       remove email addresses, remove emoji characters, lowercase.
+       The result can be given to is_english, extract_stems and extract_entities
+       with sanitized=True to sanitize only once.'''
+    # remove usernames and email addresses
+    sane_content = USERNAME_OR_EMAIL_REGEX.sub('', content)
+    # replace hashtag characters, emoji characters, various similar symbols, tabs and
+    # new lines with spaces, and remove multiple spaces, in the same pass
+    sane_content = SPACES_REGEX.sub(' ', sane_content)
+    # trim spaces and lowercase
+    return sane_content.strip().lower()
 
 def extract_content_from_url(content):
     '''Look for http(s) link inside content and extract the relevant information
        from these links using AlchemyAPI. This method extracts the content from 
        the first url found, even if there is multiple urls.'''
-    url_matcher = URL_REGEX.search(content)
+    url_matcher = url_regex().search(content)
     if url_matcher is not None:
         url = format_url(url_matcher.group(0))
-        response = alchemyapi.text('url', url)
-        if response['status'] == 'OK':
-            new_content = URL_REGEX.sub('', content + ' ' + response['text'])
-            return new_content
-        else:
-            return content
+        cache_key = 'alchemyapi:' + normalize_url(url)
+        text = api_cache.get(cache_key)
+        if text is None:
+            response = limiter.call('alchemyapi', lambda: alchemyapi().text('url', url))
+            if response['status'] != 'OK':
+                return content
+            text = response['text']
+            api_cache.put(cache_key, text)
+        new_content = url_regex().sub('', content + ' ' + text)
+        return new_content
     else:
         return content
 
+def normalize_url(url):
+    '''Normalize an url to use it as a cache key: lowercase scheme and host, 
+       no fragment, no trailing slash.'''
+    parts = urlparse.urlsplit(url.strip())
+    path = parts.path.rstrip('/')
+    return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ''))
+
 def format_url(url):
     # Check for urls without http(s)
     pos = url.find('http')
@@ -94,50 +175,83 @@ def format_url(url):
 
     return full_url
 
-def extract_stems(content):
+def extract_stems(content, sanitized=False):
     '''Sanitize, remove stopwords, tokenize and stem the content.
        Returns a list of stems'''
     # sanitize
-    sane_content = sanitize_content(content)
-    # tokenize
-    tokens = nltk.wordpunct_tokenize(sane_content)
+    sane_content = content if sanitized else sanitize_content(content)
+    # tokenize, punctuation is dropped with the special characters below
+    tokens = WORD_REGEX.findall(sane_content)
     # remove stopwords
-    tokens = [word for word in tokens if word not in ENGLISH_STOPWORDS]
+    stopwords = english_stopwords()
+    tokens = [word for word in tokens if word not in stopwords]
     # remove special characters
     tokens = [token for token in tokens if token.isalnum()]
     # stemming
-    stems = [stemmer.stem(token) for token in tokens]
+    stems = [stem_token(token) for token in tokens]
     return stems
 
-def extract_entities(content):
+def stem_token(token):
+    '''Porter stem of a token, memoized.'''
+    stem = stem_memo.get(token)
+    if stem is None:
+        stem = stemmer().stem(token)
+        stem_memo.put(token, stem)
+    return stem
+
+def extract_stems_batch(texts, processes=None, chunksize=BATCH_CHUNK_SIZE, pool=None):
+    '''extract_stems over an iterable of texts, in a pool of processes (a new one 
+       unless pool is given). Yields the list of stems of each text, in order.'''
+    return _map_batch(extract_stems, texts, processes, chunksize, pool)
+
+def is_english_batch(texts, processes=None, chunksize=BATCH_CHUNK_SIZE, pool=None):
+    '''is_english over an iterable of texts, in a pool of processes (a new one 
+       unless pool is given). Yields a boolean for each text, in order.'''
+    return _map_batch(is_english, texts, processes, chunksize, pool)
+
+def _map_batch(function, texts, processes, chunksize, pool):
+    if pool is not None:
+        for result in pool.imap(function, texts, chunksize):
+            yield result
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(function, texts, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def extract_entities(content, sanitized=False):
     '''Sanitize content and use TAGME API to extract entities.
        Returns a list of entities and their relevance score rho: [{'entity':entity, 'rho'=rho}, ...]'''
+    import requests
     entities = []
     # sanitize
-    sane_content = sanitize_content(content)
+    sane_content = content if sanitized else sanitize_content(content)
+
+    # same text, same entities
+    cache_key = 'tagme:' + sane_content
+    cached_entities = api_cache.get(cache_key)
+    if cached_entities is not None:
+        return cached_entities
+
     parameters = {
         'key':TAGME_API_KEY,
         'text':sane_content,
         'lang':'en'
     }
-    url = 'http://tagme.di.unipi.it/tag'
+    def request():
+        response = http_session().get(TAGME_URL, params=parameters)
+        limiter.update_from_headers('tagme', response.headers)
+        if response.status_code in (429, 503):
+            raise RateLimited(ratelimit.parse_number(response.headers.get('Retry-After')))
+        return response.json()
 
-    retry = True
-    retry_count = 0
-    while retry:
-        try:
-            time.sleep(0.5)
-            response = requests.get(url, params=parameters)
-            response = response.json()
-            retry = False
-        except requests.Timeout:
-            if retry_count < 9:
-                retry = True
-                retry_count = retry_count + 1
-            else: 
-                return []
-        except:
-            return []
+    try:
+        response = limiter.call('tagme', request, retry_on=(requests.Timeout,), max_retries=9)
+    except:
+        return []
 
     for annotation in response['annotations']:
         try:
@@ -146,11 +260,13 @@ def extract_entities(content):
             print '>>> traceback <<<'
             traceback.print_exc()
             print '>>> end of traceback <<<\n' 
+    api_cache.put(cache_key, entities)
     return entities 
  
-def is_english(text):
-    '''Language detection using nltk.
+def is_english(text, sanitized=False):
+    '''Language detection using nltk stopwords, on the first LANGUAGE_WINDOW characters.
        Adapted from http://www.algorithm.co.il/blogs/programming/python/cheap-language-detection-nltk/'''
-    text = sanitize_content(text)
-    words = set(nltk.wordpunct_tokenize(text))
-    return len(words & ENGLISH_STOPWORDS) > len(words & NON_ENGLISH_STOPWORDS)
+    if not sanitized:
+        text = sanitize_content(text)
+    words = set(WORD_REGEX.findall(text, 0, LANGUAGE_WINDOW))
+    return len(words & english_stopwords()) > len(words & non_english_stopwords())
@@ -0,0 +1,133 @@
+import os, json, time, hashlib, tempfile, threading
+
+# entries are spread over directories named by the first byte of their digest
+SHARD_COUNT = 256
+# fraction of its share of max_bytes a directory is brought back to when evicting
+EVICTION_TARGET = 0.9
+
+class ResponseCache(object):
+    '''Persistent cache of API responses, content addressed: each entry is a JSON file
+       named by the SHA-1 of its key. Entries expire ttl seconds after being written and
+       the least recently used ones are evicted when the cache grows over max_bytes.
+       Each of the SHARD_COUNT directories gets an equal share of max_bytes: writes keep
+       a running estimate of the size of their directory and only this directory is
+       scanned when it goes over its share.'''
+
+    def __init__(self, directory, ttl=30 * 24 * 3600, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # estimated size of each directory, read when first written
+        self._shard_bytes = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()
+        # two levels of directories to keep them small
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        '''Returns the cached value of key, None if missing or expired.'''
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if time.time() - entry['time'] > self.ttl:
+                os.remove(path)
+                entry = None
+            else:
+                # the modification time of an entry is its last access, used for eviction
+                os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            entry = None
+        if entry is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return entry['value']
+
+    def put(self, key, value):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write a temporary file then rename it, readers never see partial entries
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'time': time.time(), 'value': value}, f)
+                size = f.tell()
+            try:
+                size = size - os.path.getsize(path)
+            except OSError:
+                pass
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            shard_bytes = self._shard_bytes.get(directory)
+            if shard_bytes is not None:
+                shard_bytes = self._shard_bytes[directory] = shard_bytes + size
+        if shard_bytes is None or shard_bytes > self.max_bytes / SHARD_COUNT:
+            self._evict_shard(directory)
+
+    def evict(self):
+        '''Remove the least recently used entries of every directory over its share
+           of max_bytes. Expired entries are removed when read.'''
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            self._evict_shard(os.path.join(self.directory, name))
+
+    def _evict_shard(self, directory):
+        '''Read the size of a directory and, when over its share of max_bytes, remove
+           its least recently used entries.'''
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            # temporary files of writes in progress
+            if name.startswith('tmp'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total = total + stat.st_size
+        if total > self.max_bytes / SHARD_COUNT:
+            # leave some room so that the next writes do not scan again
+            target = self.max_bytes / SHARD_COUNT * EVICTION_TARGET
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total = total - size
+        with self._lock:
+            self._shard_bytes[directory] = total
+
+    def _count(self, key):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+    def statistics(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total > 0 else 0.
+        }
@@ -0,0 +1,232 @@
+import heapq
+import graphmanager as graph
+from operator import itemgetter
+
+# weighting factor between stems and entities in resource score calculation
+ALPHA = 0.6
+
+# number of best resources taken into account in a user score
+MAX_RESOURCES_PER_USER = 100
+
+# top_users checks its stopping condition after this number of resources, then at
+# doubling intervals, and scores every user once this fraction of the resources is walked
+FIRST_CHECK = 64
+EXHAUSTIVE_FRACTION = 0.05
+
+def distance_weight(distance):
+    '''Weight of a resource in a user score, given its distance to the user.'''
+    if distance == 1:
+        return 0.75
+    elif distance == 2:
+        return 0.5
+    return 1.
+
+class InvertedIndex(object):
+    '''In-memory inverted index over the stems and entities of the graph.
+       stem -> {resource uid: term frequency}
+       entity -> {resource uid: [count, sum of rho]}'''
+
+    def __init__(self):
+        self.stem_postings = {}
+        self.entity_postings = {}
+        # number of occurrences of each term in all the resources
+        self.stem_freq = {}
+        self.entity_freq = {}
+        # graphmanager.graph_version() when built from the graph
+        self.version = None
+
+    def build(self):
+        '''Load all the postings from the ResourceStem and ResourceEntity tables.'''
+        # read before the postings: rows added meanwhile give another version
+        self.version = graph.graph_version()
+        self.stem_postings = {}
+        self.entity_postings = {}
+        self.stem_freq = {}
+        self.entity_freq = {}
+        query = (graph.ResourceStem
+            .select(graph.ResourceStem.resource, graph.Stem.stem, graph.ResourceStem.tf)
+            .join(graph.Stem)
+            .tuples()
+            .iterator())
+        for resource_uid, stem, tf in query:
+            self.add_stem(resource_uid, stem, tf)
+
+        query = (graph.ResourceEntity
+            .select(graph.ResourceEntity.resource, graph.Entity.entity, 
+                graph.ResourceEntity.rho_sum, graph.ResourceEntity.count)
+            .join(graph.Entity)
+            .tuples()
+            .iterator())
+        for resource_uid, entity, rho_sum, count in query:
+            self.add_entity(resource_uid, entity, rho_sum, count)
+        return self
+
+    def add_stem(self, resource_uid, stem, tf=1):
+        postings = self.stem_postings.setdefault(stem, {})
+        postings[resource_uid] = postings.get(resource_uid, 0) + tf
+        self.stem_freq[stem] = self.stem_freq.get(stem, 0) + tf
+
+    def add_entity(self, resource_uid, entity, rho, count=1):
+        postings = self.entity_postings.setdefault(entity, {})
+        posting = postings.setdefault(resource_uid, [0, 0.0])
+        posting[0] = posting[0] + count
+        posting[1] = posting[1] + rho
+        self.entity_freq[entity] = self.entity_freq.get(entity, 0) + count
+
+    def score_resources(self, query_stems, query_entities):
+        '''Compute the score of every resource containing at least one query term.
+           Same formula as answerquery.compute_resource_score.
+           Returns a dict {resource uid: score}.'''
+        stem_scores = {}
+        for stem in query_stems:
+            postings = self.stem_postings.get(stem)
+            if not postings:
+                continue
+            irf = 1. / self.stem_freq[stem]
+            for resource_uid, tf in postings.iteritems():
+                stem_scores[resource_uid] = stem_scores.get(resource_uid, 0) + tf * (irf * irf)
+
+        entity_scores = {}
+        for entity in query_entities:
+            postings = self.entity_postings.get(entity['entity'])
+            if not postings:
+                continue
+            eirf = 1. / self.entity_freq[entity['entity']]
+            for resource_uid, (ef, rho_sum) in postings.iteritems():
+                # average of all rho for a given resource
+                weight = rho_sum / ef
+                if weight > 0:
+                    weight = weight + 1
+                entity_scores[resource_uid] = (entity_scores.get(resource_uid, 0)
+                    + weight * ef * (eirf * eirf))
+
+        scores = {}
+        for resource_uid in set(stem_scores) | set(entity_scores):
+            scores[resource_uid] = (ALPHA * stem_scores.get(resource_uid, 0)
+                + (1-ALPHA) * entity_scores.get(resource_uid, 0))
+        return scores
+
+class UserIndex(object):
+    '''In-memory index of the ResourceUser table for the scored users.
+       resource uid -> {user uid: distance weight}
+       user uid -> {resource uid: distance weight}'''
+
+    def __init__(self):
+        self.resource_users = {}
+        self.user_resources = {}
+        # users by decreasing number of resources counted in their score
+        self._by_resources = None
+        # graphmanager.graph_version() when built from the graph
+        self.version = None
+
+    def build(self, completed_only=True):
+        '''Load the ResourceUser rows of the (completed) users.'''
+        self.version = graph.graph_version()
+        self.resource_users = {}
+        self.user_resources = {}
+        self._by_resources = None
+        query = (graph.ResourceUser
+            .select(graph.ResourceUser.user, graph.ResourceUser.resource, graph.ResourceUser.distance)
+            .join(graph.User))
+        if completed_only:
+            query = query.where(graph.User.completed == True)
+        for user_uid, resource_uid, distance in query.tuples().iterator():
+            self.add(user_uid, resource_uid, distance)
+        return self
+
+    def add(self, user_uid, resource_uid, distance):
+        # a resource mapped several times with a user keeps its closest distance
+        weight = distance_weight(distance)
+        users = self.resource_users.setdefault(resource_uid, {})
+        users[user_uid] = max(users.get(user_uid, 0), weight)
+        resources = self.user_resources.setdefault(user_uid, {})
+        resources[resource_uid] = max(resources.get(resource_uid, 0), weight)
+        self._by_resources = None
+
+    def score_users(self, resource_scores):
+        '''Score users from their MAX_RESOURCES_PER_USER best resources.
+           Same formula as answerquery.compute_user_score.
+           Returns a dict {user uid: score} for users with a scored resource.'''
+        candidates = {}
+        for resource_uid, score in resource_scores.iteritems():
+            for user_uid, weight in self.resource_users.get(resource_uid, {}).iteritems():
+                candidates.setdefault(user_uid, []).append((score, weight))
+
+        scores = {}
+        for user_uid, resources in candidates.iteritems():
+            if len(resources) > MAX_RESOURCES_PER_USER:
+                resources = heapq.nlargest(MAX_RESOURCES_PER_USER, resources, key=itemgetter(0))
+            scores[user_uid] = sum(score * weight for score, weight in resources)
+        return scores
+
+    def best_resources(self, user_uid, resource_scores):
+        '''Resources of a user, best scored first.'''
+        return sorted(self.user_resources.get(user_uid, {}),
+            key=lambda resource_uid: resource_scores.get(resource_uid, 0), reverse=True)
+
+    def top_users(self, resource_scores, k=10):
+        '''Top k users without scoring every user (threshold algorithm).
+           Walk the resources best scored first and stop as soon as no other user 
+           can enter the top k. The condition is checked at doubling intervals; when
+           it did not hold after EXHAUSTIVE_FRACTION of the resources, the users are
+           scored exhaustively instead. Returns [(user uid, score), ...] best first.'''
+        heap = [(-score, resource_uid) for resource_uid, score in resource_scores.iteritems() if score > 0]
+        heapq.heapify(heap)
+        exhaustive_steps = EXHAUSTIVE_FRACTION * len(heap)
+        # partial scores and number of resources seen of each user
+        partial = {}
+        seen = {}
+        steps = 0
+        next_check = FIRST_CHECK
+        while heap:
+            score, resource_uid = heapq.heappop(heap)
+            score = -score
+            for user_uid, weight in self.resource_users.get(resource_uid, {}).iteritems():
+                if seen.get(user_uid, 0) < MAX_RESOURCES_PER_USER:
+                    partial[user_uid] = partial.get(user_uid, 0) + score * weight
+                    seen[user_uid] = seen.get(user_uid, 0) + 1
+            steps = steps + 1
+            if steps == next_check and heap:
+                next_check = 2 * next_check
+                if len(partial) >= k and self._is_top(partial, seen, -heap[0][0], k):
+                    break
+                if steps >= exhaustive_steps:
+                    # the bounds are too loose to stop early
+                    return sorted(heapq.nlargest(k, self.score_users(resource_scores).iteritems(),
+                        key=itemgetter(1)), key=itemgetter(1), reverse=True)
+
+        # partial scores are final once MAX_RESOURCES_PER_USER resources were seen,
+        # they were the best ones
+        top = heapq.nlargest(k, partial.iteritems(), key=itemgetter(1))
+        return sorted(((user_uid, partial_score if seen[user_uid] == MAX_RESOURCES_PER_USER 
+                else self.score_user(user_uid, resource_scores)) for user_uid, partial_score in top),
+            key=itemgetter(1), reverse=True)
+
+    def _is_top(self, partial, seen, next_score, k):
+        '''True when no user out of the k best partial scores can overtake them: the
+           remaining resources of a user score at most next_score, with a weight of at most 1.'''
+        top = heapq.nlargest(k, partial.iteritems(), key=itemgetter(1))
+        threshold = top[-1][1]
+        # a user not seen yet has all its resources left
+        if self._by_resources is None:
+            self._by_resources = sorted(((min(len(resources), MAX_RESOURCES_PER_USER), user_uid)
+                for user_uid, resources in self.user_resources.iteritems()), reverse=True)
+        for count, user_uid in self._by_resources:
+            if user_uid not in seen:
+                if threshold < count * next_score:
+                    return False
+                break
+        candidates = set(user_uid for user_uid, partial_score in top)
+        for user_uid, partial_score in partial.iteritems():
+            if user_uid not in candidates:
+                remaining = min(len(self.user_resources[user_uid]), MAX_RESOURCES_PER_USER) - seen[user_uid]
+                if partial_score + remaining * next_score > threshold:
+                    return False
+        return True
+
+    def score_user(self, user_uid, resource_scores):
+        '''Score of a single user.'''
+        resources = [(resource_scores.get(resource_uid, 0), weight)
+            for resource_uid, weight in self.user_resources.get(user_uid, {}).iteritems()]
+        resources = heapq.nlargest(MAX_RESOURCES_PER_USER, resources, key=itemgetter(0))
+        return sum(score * weight for score, weight in resources)
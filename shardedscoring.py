@@ -0,0 +1,138 @@
+import sys, heapq, multiprocessing
+import numpy as np
+from operator import itemgetter
+import graphmanager as graph
+import answerquery
+import resourceutil
+from snapshot import Snapshot
+
+class RankedResources(dict):
+    '''user uid -> best scored located resource uids, given to
+       answerquery.get_located_resources in place of a UserIndex.'''
+
+    def best_resources(self, user_uid, resource_scores):
+        return self.get(user_uid, [])
+
+class ShardedScorer(object):
+    '''Score the users of a snapshot (see snapshot.py) in parallel: users are split
+       in ranges of uids, each scored by its own process with the ResourceUser rows and
+       the postings of the resources of the range loaded once. For each query, every
+       shard scores the resources of its users and returns its top k users with their
+       best located resources, then the partial rankings are merged.'''
+
+    def __init__(self, snapshot_directory, shards=None, completed_only=True):
+        self.snapshot_directory = snapshot_directory
+        self.shards = shards or multiprocessing.cpu_count()
+        self.completed_only = completed_only
+        self.processes = []
+        self.connections = []
+
+    def start(self):
+        '''Start one process per shard.'''
+        for first_uid, last_uid in uid_ranges(Snapshot(self.snapshot_directory), self.shards):
+            connection, shard_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_shard, args=(self.snapshot_directory,
+                first_uid, last_uid, self.completed_only, shard_connection))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.connections.append(connection)
+        return self
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.connections = []
+
+    def score(self, query_stems, query_entities, k=10):
+        '''Top k users of all the shards. Returns [(user uid, score), ...] best first
+           and a RankedResources of these users.'''
+        for connection in self.connections:
+            connection.send((query_stems, query_entities, k))
+        users = []
+        ranked_resources = RankedResources()
+        for connection in self.connections:
+            for user_uid, score, resource_uids in connection.recv():
+                users.append((user_uid, score))
+                ranked_resources[user_uid] = resource_uids
+        # shards share no user: the best of the partial top k are the top k
+        return heapq.nlargest(k, users, key=itemgetter(1)), ranked_resources
+
+    def answer(self, query, limit=10):
+        '''Same output as answerquery.answer: [(user, score), ...] and their best
+           located resources.'''
+        query_stems = resourceutil.extract_stems(query)
+        query_entities = resourceutil.extract_entities(query)
+        best_users, ranked_resources = self.score(query_stems, query_entities, limit)
+        return (answerquery.get_experts(best_users),
+            answerquery.get_located_resources(best_users, None, ranked_resources, limit))
+
+def uid_ranges(snapshot, shards):
+    '''Split the user uids in shards ranges (first uid, last uid) holding about the
+       same number of ResourceUser rows. None stands for no bound.'''
+    users = np.sort(np.concatenate([segment['link_users'] for segment in snapshot.segments]
+        or [np.zeros(0, dtype=np.int64)]))
+    if len(users) == 0:
+        return [(None, None)]
+    bounds = np.unique(users[np.arange(1, shards) * len(users) // shards]).tolist()
+    return zip([None] + bounds, [bound - 1 for bound in bounds] + [None])
+
+class Shard(object):
+    '''Users of a uid range and the postings of their resources, from a snapshot.'''
+
+    def __init__(self, snapshot, first_uid=None, last_uid=None, completed_only=True):
+        self.user_index = snapshot.user_index(completed_only, first_uid, last_uid)
+        resource_uids = np.asarray(sorted(self.user_index.resource_users), dtype=np.int64)
+        self.snapshot = snapshot.restricted(resource_uids)
+        located_uids = snapshot.located_uids()
+        # None: every resource is a candidate, get_located_resources filters them
+        self.located = (None if located_uids is None
+            else set(np.intersect1d(located_uids, resource_uids).tolist()))
+
+    def score(self, query_stems, query_entities, k):
+        '''Top k users of the shard: [(user uid, score, best located resource uids), ...]'''
+        resource_scores = self.snapshot.score_resources(query_stems, query_entities)
+        # every user of the shard is scored: the shard is small and the walk of
+        # UserIndex.top_users would not pay off
+        top = heapq.nlargest(k, self.user_index.score_users(resource_scores).iteritems(), key=itemgetter(1))
+        return [(user_uid, score, self.located_resources(user_uid, resource_scores))
+            for user_uid, score in top]
+
+    def located_resources(self, user_uid, resource_scores):
+        '''The resources of a user get_located_resources can pick, best scored first.'''
+        if self.located is None:
+            return self.user_index.best_resources(user_uid, resource_scores)
+        # same order as UserIndex.best_resources
+        resource_uids = [resource_uid for resource_uid in self.user_index.user_resources.get(user_uid, {})
+            if resource_uid in self.located]
+        return heapq.nlargest(answerquery.LOCATED_RESOURCES_PER_USER, resource_uids,
+            key=lambda resource_uid: resource_scores.get(resource_uid, 0))
+
+def _serve_shard(snapshot_directory, first_uid, last_uid, completed_only, connection):
+    '''Answer the queries sent through connection with the users of a uid range.'''
+    shard = Shard(Snapshot(snapshot_directory), first_uid, last_uid, completed_only)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        connection.send(shard.score(*request))
+    connection.close()
+
+if __name__ == '__main__':
+    # usage: python shardedscoring.py snapshot_directory [shards] [query]
+    graph.init_graph()
+    scorer = ShardedScorer(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None).start()
+    query = 'What are some good place to hang out for a young professional in East London?'
+    if len(sys.argv) > 3:
+        query = sys.argv[3]
+    try:
+        experts, resources = scorer.answer(query)
+    finally:
+        scorer.close()
+    for user, score in experts:
+        print user.url + ' ' + str(score)
+    for resource in resources:
+        print resource.url
@@ -0,0 +1,295 @@
+import os, sys, copy, json, shutil, tempfile
+import numpy as np
+import graphmanager as graph
+from scoring import ALPHA, UserIndex
+
+# file describing the segments of a snapshot
+META_FILE = 'meta.json'
+
+class Snapshot(object):
+    '''Read-only columnar snapshot of the graph, written by export_snapshot and
+       append_snapshot: a directory of segments, each a set of NumPy arrays opened
+       with mmap so that several processes share the same pages.
+
+       Each segment holds the rows added to the graph since the previous one:
+       - stem postings: stem_terms (sorted, utf-8), stem_offsets (CSR offsets into
+         the next arrays), stem_resources, stem_tfs
+       - entity postings: entity_terms, entity_offsets, entity_resources,
+         entity_counts, entity_rho_sums
+       - ResourceUser rows sorted by user: link_users, link_resources, link_distances
+       - resource_uids: resources of the segment, located_uids: the ones with a
+         location name
+       - completed_users: all the completed users when the segment was written,
+         only the last segment counts'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        self.segments = [_load_segment(os.path.join(directory, name)) for name in self.meta['segments']]
+        self.completed_users = (self.segments[-1]['completed_users'] if self.segments
+            else np.zeros(0, dtype=np.int64))
+
+    def resource_count(self):
+        return sum(len(segment['resource_uids']) for segment in self.segments)
+
+    def located_uids(self):
+        '''Resources with a location name, None for snapshots written without them.'''
+        if not all('located_uids' in segment for segment in self.segments):
+            return None
+        return np.concatenate([segment['located_uids'] for segment in self.segments]
+            or [np.zeros(0, dtype=np.int64)])
+
+    def postings(self, kind, term, columns):
+        '''Postings of a stem or an entity (kind) in all the segments.
+           Returns the number of occurrences of the term in all the resources (the
+           sum of its first column), then the arrays of resource uids and of the
+           given columns.'''
+        key = term.encode('utf-8')
+        frequency = 0
+        parts = [[] for column in ('resources',) + tuple(columns)]
+        for segment in self.segments:
+            terms = segment[kind + '_terms']
+            i = np.searchsorted(terms, key)
+            if i == len(terms) or terms[i] != key:
+                continue
+            start, end = segment[kind + '_offsets'][i:i + 2]
+            for part, column in zip(parts, ('resources',) + tuple(columns)):
+                part.append(segment['%s_%s' % (kind, column)][start:end])
+            if kind + '_frequencies' in segment:
+                # postings of a restricted snapshot
+                frequency = frequency + segment[kind + '_frequencies'][i]
+            else:
+                frequency = frequency + parts[1][-1].sum()
+        return [frequency] + [np.concatenate(part) if part else np.zeros(0) for part in parts]
+
+    def restricted(self, resource_uids):
+        '''Copy of the snapshot holding in memory the postings of the given resources
+           only, with the term frequencies of all the resources: it scores these
+           resources as the whole snapshot does, without reading the other postings.'''
+        mask = _resource_mask(resource_uids)
+        snapshot = copy.copy(self)
+        snapshot.segments = []
+        for segment in self.segments:
+            segment = dict(segment)
+            for kind, columns in (('stem', ('tfs',)), ('entity', ('counts', 'rho_sums'))):
+                offsets = segment[kind + '_offsets']
+                keep = _masked(mask, segment[kind + '_resources'])
+                # occurrences of each term, counted before the other resources are left out
+                totals = np.r_[0, np.cumsum(segment['%s_%s' % (kind, columns[0])], dtype=np.int64)]
+                segment[kind + '_frequencies'] = totals[offsets[1:]] - totals[offsets[:-1]]
+                segment[kind + '_offsets'] = np.r_[0, np.cumsum(keep)][offsets]
+                for column in ('resources',) + columns:
+                    name = '%s_%s' % (kind, column)
+                    segment[name] = np.asarray(segment[name][keep])
+            snapshot.segments.append(segment)
+        return snapshot
+
+    def score_resources(self, query_stems, query_entities):
+        '''Compute the score of every resource containing at least one query term.
+           Same formula as scoring.InvertedIndex.score_resources.
+           Returns a dict {resource uid: score}.'''
+        resources, scores = [], []
+        for stem in query_stems:
+            frequency, uids, tfs = self.postings('stem', stem, ['tfs'])
+            if len(uids) == 0:
+                continue
+            irf = 1. / frequency
+            resources.append(uids)
+            scores.append(ALPHA * tfs * (irf * irf))
+
+        for entity in query_entities:
+            frequency, uids, counts, rho_sums = self.postings('entity', entity['entity'], ['counts', 'rho_sums'])
+            if len(uids) == 0:
+                continue
+            eirf = 1. / frequency
+            # rows of a resource can be split between segments
+            uids, inverse = np.unique(uids, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts)
+            rho_sums = np.bincount(inverse, weights=rho_sums)
+            # weight * ef, where weight is the average rho plus one when positive
+            resources.append(uids)
+            scores.append((1-ALPHA) * np.where(rho_sums > 0, rho_sums + counts, rho_sums) * (eirf * eirf))
+
+        if not resources:
+            return {}
+        uids, inverse = np.unique(np.concatenate(resources).astype(np.int64), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores), minlength=len(uids))
+        return dict(zip(uids.tolist(), totals.tolist()))
+
+    def user_index(self, completed_only=True, first_uid=None, last_uid=None):
+        '''scoring.UserIndex of the users with first_uid <= uid <= last_uid,
+           loaded from the ResourceUser rows of the snapshot.'''
+        index = UserIndex()
+        index.version = self.version
+        for segment in self.segments:
+            users = segment['link_users']
+            start = 0 if first_uid is None else np.searchsorted(users, first_uid)
+            end = len(users) if last_uid is None else np.searchsorted(users, last_uid, side='right')
+            users = users[start:end]
+            resources = segment['link_resources'][start:end]
+            distances = segment['link_distances'][start:end]
+            if completed_only:
+                keep = np.in1d(users, self.completed_users)
+                users, resources, distances = users[keep], resources[keep], distances[keep]
+            for user_uid, resource_uid, distance in zip(users.tolist(), resources.tolist(), distances.tolist()):
+                index.add(user_uid, resource_uid, distance)
+        return index
+
+def _resource_mask(resource_uids):
+    '''Boolean array indexed by resource uid, true for the given resources.'''
+    resource_uids = np.asarray(resource_uids, dtype=np.int64)
+    mask = np.zeros(resource_uids.max() + 1 if len(resource_uids) else 0, dtype=bool)
+    mask[resource_uids] = True
+    return mask
+
+def _masked(mask, uids):
+    keep = uids < len(mask)
+    keep[keep] = mask[uids[keep].astype(np.int64)]
+    return keep
+
+def read_version(directory):
+    '''Version of the snapshot of directory, without opening its segments.'''
+    with open(os.path.join(directory, META_FILE)) as f:
+        return json.load(f)['version']
+
+def _load_segment(path):
+    return dict((name[:-len('.npy')], np.load(os.path.join(path, name), mmap_mode='r'))
+        for name in os.listdir(path) if name.endswith('.npy'))
+
+def export_snapshot(directory):
+    '''Write a snapshot of the whole graph, replacing the snapshot of directory.'''
+    return _write_segment(directory, append=False)
+
+def append_snapshot(directory):
+    '''Add a segment with the rows added to the graph since the last segment,
+       identified by the highest uid of each table. Rows deleted or rewritten
+       since (restem, migrations) need a new export_snapshot.
+       Returns the new version of the snapshot, None if nothing changed.'''
+    if not os.path.exists(os.path.join(directory, META_FILE)):
+        return export_snapshot(directory)
+    return _write_segment(directory, append=True)
+
+def _write_segment(directory, append):
+    meta = {'version': 0, 'segments': [], 'watermarks': {}}
+    if os.path.exists(os.path.join(directory, META_FILE)):
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+    if not append:
+        # versions keep increasing over exports
+        meta['watermarks'] = {}
+    watermarks = dict(meta['watermarks'])
+    arrays = {}
+
+    query = graph.Resource.select(graph.Resource.uid).where(graph.Resource.uid > watermarks.get('resource', 0))
+    arrays['resource_uids'] = np.sort(np.fromiter((uid for (uid,) in query.tuples().iterator()), dtype=np.int64))
+    query = query.where(~(graph.Resource.location_name >> None))
+    arrays['located_uids'] = np.sort(np.fromiter((uid for (uid,) in query.tuples().iterator()), dtype=np.int64))
+
+    watermarks['resource_stem'], stem_arrays = _export_postings(graph.ResourceStem, graph.Stem.stem,
+        [graph.ResourceStem.tf], watermarks.get('resource_stem', 0))
+    arrays.update(_postings_arrays('stem', stem_arrays, [('tfs', np.int32)]))
+    watermarks['resource_entity'], entity_arrays = _export_postings(graph.ResourceEntity, graph.Entity.entity,
+        [graph.ResourceEntity.count, graph.ResourceEntity.rho_sum], watermarks.get('resource_entity', 0))
+    arrays.update(_postings_arrays('entity', entity_arrays, [('counts', np.int32), ('rho_sums', np.float64)]))
+
+    users, resources, distances = [], [], []
+    last_uid = watermarks.get('resource_user', 0)
+    for uid, user_uid, resource_uid, distance in (graph.ResourceUser
+        .select(graph.ResourceUser.uid, graph.ResourceUser.user, graph.ResourceUser.resource,
+            graph.ResourceUser.distance)
+        .where(graph.ResourceUser.uid > last_uid)
+        .tuples()
+        .iterator()):
+        users.append(user_uid)
+        resources.append(resource_uid)
+        distances.append(distance)
+        last_uid = max(last_uid, uid)
+    watermarks['resource_user'] = last_uid
+    users = np.asarray(users, dtype=np.int64)
+    resources = np.asarray(resources, dtype=np.int64)
+    order = np.lexsort((resources, users))
+    arrays['link_users'] = users[order]
+    arrays['link_resources'] = resources[order]
+    arrays['link_distances'] = np.asarray(distances, dtype=np.int8)[order]
+
+    arrays['completed_users'] = np.sort(np.fromiter((uid for (uid,) in
+        graph.User.select(graph.User.uid).where(graph.User.completed == True).tuples().iterator()),
+        dtype=np.int64))
+
+    if arrays['resource_uids'].size:
+        watermarks['resource'] = int(arrays['resource_uids'][-1])
+    if append and watermarks == meta['watermarks'] and np.array_equal(
+            arrays['completed_users'], Snapshot(directory).completed_users):
+        return None
+
+    # write the segment and the new meta file aside, then rename them:
+    # readers see the previous snapshot until the meta file is replaced
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = 'segment-%06d' % (meta['version'] + 1)
+    tmp_path = tempfile.mkdtemp(dir=directory)
+    for key, array in arrays.iteritems():
+        np.save(os.path.join(tmp_path, key + '.npy'), array)
+    os.rename(tmp_path, os.path.join(directory, name))
+    previous_segments = meta['segments']
+    meta = {
+        'version': meta['version'] + 1,
+        'segments': previous_segments + [name] if append else [name],
+        'watermarks': watermarks
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp_path, os.path.join(directory, META_FILE))
+    if not append:
+        # processes that opened the previous snapshot keep their mapping
+        for old_name in previous_segments:
+            shutil.rmtree(os.path.join(directory, old_name), ignore_errors=True)
+    return meta['version']
+
+def _export_postings(link, term_field, value_fields, last_uid):
+    '''Read the rows of a link table with uid > last_uid.
+       Returns the highest uid read and (terms, resource uids, [values of each field]).'''
+    terms, resources, values = [], [], [[] for field in value_fields]
+    for row in (link
+        .select(link.uid, term_field, link.resource, *value_fields)
+        .join(term_field.model_class)
+        .where(link.uid > last_uid)
+        .tuples()
+        .iterator()):
+        last_uid = max(last_uid, row[0])
+        terms.append(row[1].encode('utf-8'))
+        resources.append(row[2])
+        for column, value in zip(values, row[3:]):
+            column.append(value)
+    return last_uid, (terms, resources, values)
+
+def _postings_arrays(kind, postings, columns):
+    '''CSR arrays of postings: sorted terms, offsets of the postings of each term,
+       then resource uids and values sorted by term and resource.'''
+    terms, resources, values = postings
+    unique_terms, term_ids = np.unique(np.asarray(terms, dtype=np.string_), return_inverse=True)
+    resources = np.asarray(resources, dtype=np.int64)
+    order = np.lexsort((resources, term_ids))
+    arrays = {
+        kind + '_terms': unique_terms,
+        kind + '_offsets': np.r_[0, np.cumsum(np.bincount(term_ids, minlength=len(unique_terms)))].astype(np.int64),
+        kind + '_resources': resources[order]
+    }
+    for (name, dtype), column in zip(columns, values):
+        arrays['%s_%s' % (kind, name)] = np.asarray(column, dtype=dtype)[order]
+    return arrays
+
+if __name__ == '__main__':
+    # usage: python snapshot.py export|append directory
+    if len(sys.argv) == 3 and sys.argv[1] in ('export', 'append'):
+        graph.db.connect()
+        if sys.argv[1] == 'export':
+            version = export_snapshot(sys.argv[2])
+        else:
+            version = append_snapshot(sys.argv[2])
+        print 'snapshot version: ' + str(version)
+    else:
+        print 'usage: python snapshot.py export|append directory'